@@ -52,7 +52,7 @@ from gprofiler.utils import (
     reset_umask,
 )
 from gprofiler.utils.fs import resource_path
-from gprofiler.utils.process import run_process
+from gprofiler.utils.process import new_maps_scan_round, run_process
 from gprofiler.utils.proxy import get_https_proxy
 
 logger: logging.LoggerAdapter
@@ -256,6 +256,8 @@ class GProfiler:
     def _snapshot(self) -> None:
         local_start_time = datetime.datetime.utcnow()
         monotonic_start_time = time.monotonic()
+        # the process profilers select their processes concurrently, let them share a single /proc/*/maps scan.
+        new_maps_scan_round()
         process_profilers_futures = []
         for prof in self.process_profilers:
             prof_future = self._executor.submit(prof.snapshot)
@@ -622,6 +624,9 @@ def parse_cmd_args() -> configargparse.Namespace:
     if args.nodejs_mode in ("perf", "attach-maps") and args.perf_mode not in ("fp", "smart"):
         parser.error("--nodejs-mode perf or attach-maps requires --perf-mode 'fp' or 'smart'")
 
+    if args.perf_lbr and args.perf_mode != "smart":
+        parser.error("--perf-lbr requires --perf-mode 'smart'")
+
     return args
 
 
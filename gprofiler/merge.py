@@ -9,7 +9,7 @@ import re
 from collections import Counter, defaultdict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from granulate_utils.metadata import Metadata
 
@@ -94,26 +94,29 @@ def parse_many_collapsed(text: str) -> ProcessToStackSampleCounters:
     return results
 
 
-def _collapse_stack(comm: str, stack: str) -> str:
+def _collapse_frame(line: str) -> str:
     """
-    Collapse a single stack from "perf".
+    Collapse a single frame line of a "perf" stack into its symbol.
+    """
+    m = FRAME_REGEX.match(line)
+    assert m is not None, f"bad line: {line}"
+    sym, dso = m.groups()
+    sym = sym.split("+")[0]  # strip the offset part.
+    if sym == "[unknown]" and dso != "[unknown]":
+        sym = f"[{dso}]"
+    # append kernel annotation
+    elif "kernel" in dso or "vmlinux" in dso:
+        sym += "_[k]"
+    return sym
+
+
+def merge_global_perfs(
+    raw_fp_perf: Optional[Iterable[bytes]], raw_dwarf_perf: Optional[Iterable[bytes]]
+) -> ProcessToStackSampleCounters:
+    """
+    Parses & merges the outputs of the FP and DWARF "perf script"s. The outputs are given as iterables of lines
+    (e.g the stdout of "perf script") and are consumed lazily.
     """
-    funcs = [comm]
-    for line in reversed(stack.splitlines()):
-        m = FRAME_REGEX.match(line)
-        assert m is not None, f"bad line: {line}"
-        sym, dso = m.groups()
-        sym = sym.split("+")[0]  # strip the offset part.
-        if sym == "[unknown]" and dso != "[unknown]":
-            sym = f"[{dso}]"
-        # append kernel annotation
-        elif "kernel" in dso or "vmlinux" in dso:
-            sym += "_[k]"
-        funcs.append(sym)
-    return ";".join(funcs)
-
-
-def merge_global_perfs(raw_fp_perf: Optional[str], raw_dwarf_perf: Optional[str]) -> ProcessToStackSampleCounters:
     fp_perf = _parse_perf_script(raw_fp_perf)
     dwarf_perf = _parse_perf_script(raw_dwarf_perf)
 
@@ -122,8 +125,8 @@ def merge_global_perfs(raw_fp_perf: Optional[str], raw_dwarf_perf: Optional[str]
     elif raw_dwarf_perf is None:
         return fp_perf
 
-    total_fp_samples = sum([sum(stacks.values()) for stacks in fp_perf.values()])
-    total_dwarf_samples = sum([sum(stacks.values()) for stacks in dwarf_perf.values()])
+    total_fp_samples = sum(sum(stacks.values()) for stacks in fp_perf.values())
+    total_dwarf_samples = sum(sum(stacks.values()) for stacks in dwarf_perf.values())
     fp_to_dwarf_sample_ratio = total_fp_samples / total_dwarf_samples
 
     # The FP perf is used here as the "main" perf, to which the DWARF perf is scaled.
@@ -203,29 +206,58 @@ def get_average_frame_count(samples: Iterable[str]) -> float:
     return sum(frame_count_per_samples) / len(frame_count_per_samples)
 
 
-def _parse_perf_script(script: Optional[str]) -> ProcessToStackSampleCounters:
+def _iter_perf_script_samples(script: Iterable[bytes]) -> Iterator[List[str]]:
+    """
+    Groups the lines of "perf script" output into samples, which are separated by empty lines.
+    """
+    sample_lines: List[str] = []
+    for raw_line in script:
+        line = raw_line.decode("utf8").rstrip("\n")
+        if line == "":
+            if sample_lines:
+                yield sample_lines
+                sample_lines = []
+        else:
+            sample_lines.append(line)
+
+    if sample_lines:
+        yield sample_lines
+
+
+def _parse_perf_script(script: Optional[Iterable[bytes]]) -> ProcessToStackSampleCounters:
+    """
+    Parses "perf script" output into collapsed stacks, in a single pass over its lines. Each sample is a header line
+    followed by its frame lines (innermost first), which are collapsed as-is, without rebuilding the sample text.
+    """
     pid_to_collapsed_stacks_counters: ProcessToStackSampleCounters = defaultdict(Counter)
 
     if script is None:
         return pid_to_collapsed_stacks_counters
 
-    for sample in script.split("\n\n"):
+    # the same frame lines (address, symbol & DSO) repeat across many samples, so we collapse each distinct
+    # line only once.
+    collapsed_frames: Dict[str, str] = {}
+
+    for sample_lines in _iter_perf_script_samples(script):
         try:
-            if sample.strip() == "":
-                continue
-            if sample.startswith("#"):
+            header, frame_lines = sample_lines[0], sample_lines[1:]
+            if header.strip() == "" or header.startswith("#"):
                 continue
-            match = SAMPLE_REGEX.match(sample)
+            match = SAMPLE_REGEX.match(header)
             if match is None:
                 raise Exception("Failed to match sample")
-            sample_dict = match.groupdict()
 
-            pid = int(sample_dict["pid"])
-            comm = sample_dict["comm"]
-            stack = sample_dict["stack"]
-            if stack is not None:
-                pid_to_collapsed_stacks_counters[pid][_collapse_stack(comm, stack)] += 1
+            pid = int(match.group("pid"))
+            if frame_lines:
+                funcs = [match.group("comm")]
+                for line in reversed(frame_lines):
+                    func = collapsed_frames.get(line)
+                    if func is None:
+                        func = collapsed_frames[line] = _collapse_frame(line)
+                    funcs.append(func)
+                pid_to_collapsed_stacks_counters[pid][";".join(funcs)] += 1
         except Exception:
+            sample = "\n".join(sample_lines)
             logger.exception(f"Error processing sample: {sample}")
     return pid_to_collapsed_stacks_counters
 
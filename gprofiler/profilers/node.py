@@ -2,32 +2,52 @@
 # Copyright (c) Granulate. All rights reserved.
 # Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
 #
+import concurrent.futures
 import json
 import os
-import shutil
+import re
 import signal
+import socket
 import stat
-from functools import lru_cache
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
 from pathlib import Path
-from threading import Event
-from typing import Any, Dict, List, cast
+from threading import Event, Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
 
 import psutil
 import requests
 from granulate_utils.linux.ns import get_proc_root_path, get_process_nspid, resolve_proc_root_links, run_in_ns
 from granulate_utils.linux.process import is_musl, is_process_running
+from requests.adapters import HTTPAdapter
 from retry import retry
+from urllib3.util.retry import Retry
 from websocket import create_connection
 from websocket._core import WebSocket
 
 from gprofiler.log import get_logger_adapter
 from gprofiler.metadata.versions import get_exe_version
 from gprofiler.utils import TEMPORARY_STORAGE_PATH, add_permission_dir
-from gprofiler.utils.fs import resource_path
+from gprofiler.utils.fs import link_tree, resource_path
 from gprofiler.utils.process import pgrep_exe
 
 logger = get_logger_adapter(__name__)
 
+_MAX_NODE_ATTACH_WORKERS = 16
+_NODE_RE = re.compile(r".*node[^/]*$")
+# when killing process with SIGUSR1 it will open new debugger session on port 9229,
+# so it will always the same. When another debugger is opened in same NS it will not open new one.
+# REF: Inspector agent initialization uses host_port
+# https://github.com/nodejs/node/blob/5fad0b93667ffc6e4def52996b9529ac99b26319/src/inspector_agent.cc#L668
+# host_port defaults to 9229
+# ref: https://github.com/nodejs/node/blob/2849283c4cebbfbf523cc24303941dc36df9332f/src/node_options.h#L90
+# in our case it won't be changed
+_NODE_DEBUGGER_PORT = 9229
+_DEBUGGER_PORT_WAIT_TIMEOUT = 5.0
+_DEBUGGER_PORT_POLL_INTERVAL = 0.1
+
 
 class NodeDebuggerUrlNotFound(Exception):
     pass
@@ -37,27 +57,63 @@ class NodeDebuggerUnexpectedResponse(Exception):
     pass
 
 
+@dataclass
+class _NodeProcessContext:
+    """
+    Details of a Node process we've attached to. All of these are fixed for the lifetime of the process, so
+    they are computed once when attaching and reused in the following snapshots & when cleaning up.
+    """
+
+    ns_link_name: str  # link name of the pid namespace of the process
+    nspid: int
+    node_major_version: str
+    module_path: str  # path of the module inside the mount namespace of the process
+    # validated debugger URL of the process, so we don't query & validate it again when stopping the module.
+    # the connections themselves are closed after each use: Node waits for connected debugger sessions to
+    # disconnect before exiting, so we must not keep them open.
+    debugger_url: Optional[str] = None
+
+
+# (pid, create_time) -> context of the attached process. kept by the profiler attaching to the processes.
+NodeProcessContexts = Dict[Tuple[int, float], _NodeProcessContext]
+# git revision of the bundled Node module, set by load_dso_git_rev().
+_DSO_GIT_REV = ""
+# processes sharing a mount namespace share the module directory, so copying it is serialized.
+_copy_module_lock = Lock()
+
+
+def prune_node_processes_cache(processes: List[psutil.Process], contexts: NodeProcessContexts) -> None:
+    """Drops the contexts of processes which are not in 'processes' (i.e, they have exited)"""
+    alive = {(process.pid, process.create_time()) for process in processes}
+    for key in list(contexts.keys()):
+        if key not in alive:
+            del contexts[key]
+
+
 def _get_node_major_version(process: psutil.Process) -> str:
     node_version = get_exe_version(process, Event(), 3)
     # i. e. v16.3.2 -> 16
     return node_version[1:].split(".")[0]
 
 
-@lru_cache(maxsize=1)
-def _get_dso_git_rev() -> str:
-    libc_dso_version_file = resource_path(os.path.join("node", "module", "glibc", "version"))
-    musl_dso_version_file = resource_path(os.path.join("node", "module", "musl", "version"))
-    libc_dso_ver = Path(libc_dso_version_file).read_text()
-    musl_dso_ver = Path(musl_dso_version_file).read_text()
+def load_dso_git_rev() -> None:
+    """Reads the git revision of the bundled Node module. Must be called before attaching to Node processes."""
+    global _DSO_GIT_REV
+    libc_dso_ver = Path(resource_path("node/module/glibc/version")).read_text()
+    musl_dso_ver = Path(resource_path("node/module/musl/version")).read_text()
     # with no build errors this should always be the same
     assert libc_dso_ver == musl_dso_ver
-    return libc_dso_ver
+    _DSO_GIT_REV = libc_dso_ver
+
+
+def _get_dso_git_rev() -> str:
+    assert _DSO_GIT_REV, "the Node module git revision is not loaded, call load_dso_git_rev() first"
+    return _DSO_GIT_REV
 
 
-@lru_cache()
 def _get_dest_inside_container(musl: bool, node_version: str) -> str:
     libc = "musl" if musl else "glibc"
-    return os.path.join(TEMPORARY_STORAGE_PATH, "node_module", _get_dso_git_rev(), libc, node_version)
+    return f"{TEMPORARY_STORAGE_PATH}/node_module/{_get_dso_git_rev()}/{libc}/{node_version}"
 
 
 def _start_debugger(pid: int) -> None:
@@ -65,17 +121,43 @@ def _start_debugger(pid: int) -> None:
     os.kill(pid, signal.SIGUSR1)
 
 
-@retry(NodeDebuggerUrlNotFound, 5, 1)
+def _wait_for_debugger_port(timeout: float) -> None:
+    """
+    Waits for the inspector, opened by _start_debugger(), to listen on the debugger port. Polling with connect()
+    lets us proceed as soon as it's up, instead of backing off between HTTP requests.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", _NODE_DEBUGGER_PORT), timeout=timeout).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() >= deadline:
+                raise NodeDebuggerUrlNotFound(f"Debugger is not listening on port {_NODE_DEBUGGER_PORT}")
+            time.sleep(_DEBUGGER_PORT_POLL_INTERVAL)
+
+
+def _make_debugger_session() -> requests.Session:
+    session = requests.Session()
+    # transient connection errors and 502/503 are retried by urllib3 with exponential backoff,
+    # over the same pooled connection.
+    retries = Retry(total=5, backoff_factor=0.2, status_forcelist=[502, 503], raise_on_status=False)
+    session.mount("http://", HTTPAdapter(max_retries=retries))
+    return session
+
+
 def _get_debugger_url() -> str:
-    # when killing process with SIGUSR1 it will open new debugger session on port 9229,
-    # so it will always the same. When another debugger is opened in same NS it will not open new one.
-    # REF: Inspector agent initialization uses host_port
-    # https://github.com/nodejs/node/blob/5fad0b93667ffc6e4def52996b9529ac99b26319/src/inspector_agent.cc#L668
-    # host_port defaults to 9229
-    # ref: https://github.com/nodejs/node/blob/2849283c4cebbfbf523cc24303941dc36df9332f/src/node_options.h#L90
-    # in our case it won't be changed
-    port = 9229
-    debugger_url_response = requests.get(f"http://127.0.0.1:{port}/json/list", timeout=3)
+    _wait_for_debugger_port(_DEBUGGER_PORT_WAIT_TIMEOUT)
+    # the session is used for a single process: its pooled connection to 127.0.0.1 belongs to the network
+    # namespace we're currently running in, so it must not be shared between processes in different namespaces.
+    with _make_debugger_session() as session:
+        return _query_debugger_url(session)
+
+
+# the debugger may list no targets for a short while after it opens, so retry that as well.
+@retry(NodeDebuggerUrlNotFound, tries=5, delay=0.2, backoff=2)
+def _query_debugger_url(session: requests.Session) -> str:
+    debugger_url_response = session.get(f"http://127.0.0.1:{_NODE_DEBUGGER_PORT}/json/list", timeout=3)
     if debugger_url_response.status_code != 200 or "application/json" not in debugger_url_response.headers.get(
         "Content-Type", ""
     ):
@@ -95,14 +177,40 @@ def _get_debugger_url() -> str:
     return cast(str, response_json[0]["webSocketDebuggerUrl"])
 
 
-def _send_socket_request(sock: WebSocket, cdp_request: Dict) -> None:
-    sock.send(json.dumps(cdp_request))
+@lru_cache(maxsize=None)
+def _make_evaluate_request(expression: str, request_id: int = 1) -> str:
+    """Serializes a CDP Runtime.evaluate request. We only send a handful of distinct expressions, so cache them."""
+    return json.dumps(
+        {
+            "id": request_id,
+            "method": "Runtime.evaluate",
+            "params": {
+                "expression": expression,
+                "replMode": True,
+            },
+        }
+    )
+
+
+_MODULE_PATH_PLACEHOLDER = "__MODULE_PATH__"
+# pre-serialized requests for _change_dso_state(), only the module path is substituted in.
+_CHANGE_DSO_STATE_REQUESTS = {
+    action: _make_evaluate_request(f'process.mainModule.require("{_MODULE_PATH_PLACEHOLDER}/linux-perf.js").{action}()')
+    for action in ("start", "stop")
+}
+
+
+def _recv_socket_response(sock: WebSocket) -> Dict:
     message = sock.recv()
     try:
-        message = json.loads(message)
+        return cast(Dict, json.loads(message))
     except json.JSONDecodeError:
         raise NodeDebuggerUnexpectedResponse(message)
 
+
+def _send_socket_request(sock: WebSocket, cdp_request: str) -> None:
+    sock.send(cdp_request)
+    message = _recv_socket_response(sock)
     if (
         "result" not in message.keys()
         or "result" not in message["result"].keys()
@@ -112,59 +220,75 @@ def _send_socket_request(sock: WebSocket, cdp_request: Dict) -> None:
         raise NodeDebuggerUnexpectedResponse(message)
 
 
-def _execute_js_command(sock: WebSocket, command: str) -> Any:
-    cdp_request = {
-        "id": 1,
-        "method": "Runtime.evaluate",
-        "params": {
-            "expression": command,
-            "replMode": True,
-        },
-    }
-    sock.send(json.dumps(cdp_request))
-    message = sock.recv()
-    try:
-        message = json.loads(message)
-    except json.JSONDecodeError:
-        raise NodeDebuggerUnexpectedResponse(message)
+def _get_evaluate_result(message: Dict) -> Any:
     try:
         return message["result"]["result"]["value"]
     except KeyError:
         raise NodeDebuggerUnexpectedResponse(message)
 
 
+def _execute_js_commands(sock: WebSocket, commands: List[str]) -> List[Any]:
+    """
+    Evaluates 'commands' and returns their results. The requests are pipelined: all are sent before waiting
+    for the responses, so they take a single round-trip to the debugger.
+    """
+    for request_id, command in enumerate(commands, 1):
+        sock.send(_make_evaluate_request(command, request_id))
+
+    responses: Dict[int, Dict] = {}
+    while len(responses) < len(commands):
+        message = _recv_socket_response(sock)
+        request_id = message.get("id")
+        if not isinstance(request_id, int) or not 1 <= request_id <= len(commands) or request_id in responses:
+            raise NodeDebuggerUnexpectedResponse(message)
+        responses[request_id] = message
+
+    return [_get_evaluate_result(responses[request_id]) for request_id in range(1, len(commands) + 1)]
+
+
 def _change_dso_state(sock: WebSocket, module_path: str, action: str) -> None:
-    assert action in ("start", "stop"), "_change_dso_state supports only start and stop actions"
-    cdp_request = {
-        "id": 1,
-        "method": "Runtime.evaluate",
-        "params": {
-            "expression": f'process.mainModule.require("{os.path.join(module_path, "linux-perf.js")}").{action}()',
-            "replMode": True,
-        },
-    }
-    _send_socket_request(sock, cdp_request)
-
-
-def _validate_ns_node(sock: WebSocket, expected_ns_link_name: str) -> None:
-    command = 'const fs = process.mainModule.require("fs"); fs.readlinkSync("/proc/self/ns/pid")'
-    actual_ns_link_name = cast(str, _execute_js_command(sock, command))
+    assert action in _CHANGE_DSO_STATE_REQUESTS, "_change_dso_state supports only start and stop actions"
+    # module_path is a path we generate (see _get_dest_inside_container) so it needs no JSON escaping.
+    _send_socket_request(
+        sock, _CHANGE_DSO_STATE_REQUESTS[action].replace(_MODULE_PATH_PLACEHOLDER, module_path.rstrip("/"))
+    )
+
+
+def _validate_ns_node_and_pid(sock: WebSocket, expected_ns_link_name: str, expected_pid: int) -> None:
+    ns_command = 'const fs = process.mainModule.require("fs"); fs.readlinkSync("/proc/self/ns/pid")'
+    actual_ns_link_name, actual_pid = _execute_js_commands(sock, [ns_command, "process.pid"])
     assert (
         actual_ns_link_name == expected_ns_link_name
     ), f"Wrong namespace, expected {expected_ns_link_name}, got {actual_ns_link_name}"
-
-
-def _validate_pid(expected_pid: int, sock: WebSocket) -> None:
-    actual_pid = cast(int, _execute_js_command(sock, "process.pid"))
     assert expected_pid == actual_pid, f"Wrong pid, expected {expected_pid}, actual {actual_pid}"
 
 
-def create_debugger_socket(nspid: int, ns_link_name: str) -> WebSocket:
-    debugger_url = _get_debugger_url()
+def create_debugger_socket(debugger_url: str, nspid: int, ns_link_name: str, validate: bool = True) -> WebSocket:
     sock = create_connection(debugger_url)
     sock.settimeout(10)
-    _validate_ns_node(sock, ns_link_name)
-    _validate_pid(nspid, sock)
+    if validate:
+        _validate_ns_node_and_pid(sock, ns_link_name, nspid)
+    return sock
+
+
+def _connect_debugger(ctx: _NodeProcessContext) -> WebSocket:
+    """
+    Connects to the debugger of the process, reusing its cached debugger URL if possible.
+    Must be called from within the namespaces of the process.
+    """
+    if ctx.debugger_url is not None:
+        try:
+            # the URL contains the unique id of the debugger session, which we've validated when we got it,
+            # so if we can still connect to it - it's the same process.
+            return create_debugger_socket(ctx.debugger_url, ctx.nspid, ctx.ns_link_name, validate=False)
+        except Exception:
+            # the debugger session might have been restarted, with a new URL. fetch it again.
+            logger.debug(f"Cached debugger URL of nspid {ctx.nspid} is no longer valid", exc_info=True)
+            ctx.debugger_url = None
+
+    debugger_url = _get_debugger_url()
+    sock = create_debugger_socket(debugger_url, ctx.nspid, ctx.ns_link_name)
+    ctx.debugger_url = debugger_url
     return sock
 
 
@@ -173,67 +297,102 @@ def _copy_module_into_process_ns(process: psutil.Process, musl: bool, version: s
     libc = "musl" if musl else "glibc"
     dest_inside_container = _get_dest_inside_container(musl, version)
     dest = resolve_proc_root_links(proc_root, dest_inside_container)
-    if os.path.exists(dest):
-        return dest_inside_container
-    src = resource_path(os.path.join("node", "module", libc, _get_dso_git_rev(), version))
-    shutil.copytree(src, dest)
-    add_permission_dir(dest, stat.S_IROTH, stat.S_IXOTH | stat.S_IROTH)
+    with _copy_module_lock:
+        if os.path.exists(dest):
+            return dest_inside_container
+        src = resource_path(f"node/module/{libc}/{_get_dso_git_rev()}/{version}")
+        link_tree(src, dest)
+        add_permission_dir(dest, stat.S_IROTH, stat.S_IXOTH | stat.S_IROTH)
     return dest_inside_container
 
 
-def _generate_perf_map(module_path: str, nspid: int, ns_link_name: str) -> None:
-    sock = create_debugger_socket(nspid, ns_link_name)
-    _change_dso_state(sock, module_path, "start")
+def _change_dso_state_in_ns(ctx: _NodeProcessContext, action: str) -> None:
+    """
+    _change_dso_state() over a new debugger connection to the process. Must be called from within the namespaces of
+    the process.
+    """
+    sock = _connect_debugger(ctx)
+    try:
+        _change_dso_state(sock, ctx.module_path, action)
+    finally:
+        sock.close()
+
+
+def _generate_perf_map(ctx: _NodeProcessContext) -> None:
+    _change_dso_state_in_ns(ctx, "start")
 
 
-def _clean_up(module_path: str, nspid: int, ns_link_name: str) -> None:
-    sock = create_debugger_socket(nspid, ns_link_name)
+def _clean_up(ctx: _NodeProcessContext) -> None:
     try:
-        _change_dso_state(sock, module_path, "stop")
+        _change_dso_state_in_ns(ctx, "stop")
     finally:
-        os.remove(os.path.join("/tmp", f"perf-{nspid}.map"))
+        os.remove(os.path.join("/tmp", f"perf-{ctx.nspid}.map"))
 
 
 def get_node_processes() -> List[psutil.Process]:
-    return pgrep_exe(r".*node[^/]*$")
-
-
-def generate_map_for_node_processes(processes: List[psutil.Process]) -> None:
+    return pgrep_exe(_NODE_RE)
+
+
+def _run_for_node_processes(
+    processes: List[psutil.Process], handle_one: Callable[[psutil.Process], None], failure_message: str
+) -> None:
+    """
+    Runs 'handle_one' for each process, concurrently - each run spends most of its time waiting on
+    the debugger of its process.
+    """
+    if not processes:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(_MAX_NODE_ATTACH_WORKERS, len(processes))) as executor:
+        futures = {executor.submit(handle_one, process): process for process in processes}
+        for future in concurrent.futures.as_completed(futures):
+            process = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"{failure_message} for pid {process.pid}. Reason: {e}", exc_info=True)
+
+
+def generate_map_for_node_processes(processes: List[psutil.Process], contexts: NodeProcessContexts) -> None:
     """Iterates over all NodeJS processes, starts debugger for it, finds debugger URL,
-    copies node-linux-perf module into process' namespace, loads module and starts it."""
-    for process in processes:
-        try:
-            musl = is_musl(process)
-            node_major_version = _get_node_major_version(process)
-            dest = _copy_module_into_process_ns(process, musl, node_major_version)
-            nspid = get_process_nspid(process.pid)
+    copies node-linux-perf module into process' namespace, loads module and starts it.
+    The contexts of the processes are added to 'contexts'."""
+
+    def _handle_one(process: psutil.Process) -> None:
+        # a single read of the process' stat/status serves all of the queries on it
+        with process.oneshot():
+            key = (process.pid, process.create_time())
             ns_link_name = os.readlink(f"/proc/{process.pid}/ns/pid")
-            _start_debugger(process.pid)
-            run_in_ns(
-                ["pid", "mnt", "net"],
-                lambda: _generate_perf_map(dest, nspid, ns_link_name),
-                process.pid,
-                passthrough_exception=True,
-            )
-        except Exception as e:
-            logger.warning(f"Could not create debug symbols for pid {process.pid}. Reason: {e}", exc_info=True)
-
-
-def clean_up_node_maps(processes: List[psutil.Process]) -> None:
-    """Stops generating perf maps for each NodeJS process and cleans up generated maps"""
-    for process in processes:
-        try:
-            if not is_process_running(process):
-                continue
-            node_major_version = _get_node_major_version(process)
             nspid = get_process_nspid(process.pid)
-            ns_link_name = os.readlink(f"/proc/{process.pid}/ns/pid")
-            dest = _get_dest_inside_container(is_musl(process), node_major_version)
-            run_in_ns(
-                ["pid", "mnt", "net"],
-                lambda: _clean_up(dest, nspid, ns_link_name),
-                process.pid,
-                passthrough_exception=True,
-            )
-        except Exception as e:
-            logger.warning(f"Could not clean up debug symbols for pid {process.pid}. Reason: {e}", exc_info=True)
+            musl = is_musl(process)
+            node_major_version = _get_node_major_version(process)
+        module_path = _copy_module_into_process_ns(process, musl, node_major_version)
+        # saved before starting the module, so clean_up_node_maps() stops it even if we fail midway.
+        ctx = _NodeProcessContext(ns_link_name, nspid, node_major_version, module_path)
+        contexts[key] = ctx
+        _start_debugger(process.pid)
+        run_in_ns(
+            ["pid", "mnt", "net"],
+            partial(_generate_perf_map, ctx),
+            process.pid,
+            passthrough_exception=True,
+        )
+
+    _run_for_node_processes(processes, _handle_one, "Could not create debug symbols")
+
+
+def clean_up_node_maps(processes: List[psutil.Process], contexts: NodeProcessContexts) -> None:
+    """Stops generating perf maps for each NodeJS process (found in 'contexts') and cleans up generated maps"""
+
+    def _handle_one(process: psutil.Process) -> None:
+        ctx = contexts.pop((process.pid, process.create_time()), None)
+        if ctx is None or not is_process_running(process):
+            return  # we haven't attached to it
+        run_in_ns(
+            ["pid", "mnt", "net"],
+            partial(_clean_up, ctx),
+            process.pid,
+            passthrough_exception=True,
+        )
+
+    _run_for_node_processes(processes, _handle_one, "Could not clean up debug symbols")
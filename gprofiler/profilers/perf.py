@@ -6,27 +6,36 @@ import functools
 import os
 import signal
 import struct
+from contextlib import ExitStack
 from pathlib import Path
 from subprocess import Popen
+from tempfile import TemporaryFile
 from threading import Event
-from typing import Any, Dict, List, Optional
+from types import TracebackType
+from typing import Any, Dict, Iterator, List, Optional, Type
 
 from granulate_utils.linux.elf import is_statically_linked, read_elf_symbol, read_elf_va
 from granulate_utils.linux.process import is_musl, is_process_running
 from psutil import NoSuchProcess, Process
 
 from gprofiler import merge
-from gprofiler.exceptions import StopEventSetException
+from gprofiler.exceptions import CalledProcessError, StopEventSetException
 from gprofiler.gprofiler_types import AppMetadata, ProcessToProfileData, ProfileData
 from gprofiler.log import get_logger_adapter
 from gprofiler.metadata.application_metadata import ApplicationMetadata
-from gprofiler.profilers.node import clean_up_node_maps, generate_map_for_node_processes, get_node_processes
+from gprofiler.profilers.node import (
+    NodeProcessContexts,
+    clean_up_node_maps,
+    generate_map_for_node_processes,
+    get_node_processes,
+    load_dso_git_rev,
+    prune_node_processes_cache,
+)
 from gprofiler.profilers.profiler_base import ProfilerBase
 from gprofiler.profilers.registry import ProfilerArgument, register_profiler
-from gprofiler.utils import wait_event
-from gprofiler.utils.perf import perf_path
+from gprofiler.utils.perf import is_lbr_supported, perf_path
 from gprofiler.utils.process import is_process_basename_matching, start_process, run_process
-from gprofiler.utils.fs import wait_for_file_by_prefix
+from gprofiler.utils.fs import removed_path, wait_for_file_by_prefix, wait_for_glob
 
 logger = get_logger_adapter(__name__)
 
@@ -39,27 +48,25 @@ class PerfProcess:
     _poll_timeout_s = 5
     # default number of pages used by "perf record" when perf_event_mlock_kb=516
     # we use double for dwarf.
-    _mmap_sizes = {"fp": 129, "dwarf": 257}
+    _mmap_sizes = {"fp": 129, "dwarf": 257, "lbr": 129}
 
     def __init__(
         self,
         frequency: int,
         stop_event: Event,
         output_path: str,
-        is_dwarf: bool,
+        perf_type: str,
         inject_jit: bool,
         extra_args: List[str],
     ):
         self._frequency = frequency
         self._stop_event = stop_event
         self._output_path = output_path
-        self._type = "dwarf" if is_dwarf else "fp"
+        assert perf_type in self._mmap_sizes, f"unexpected perf type: {perf_type!r}"
+        self._type = perf_type
         self._inject_jit = inject_jit
-        self._extra_args = extra_args + (["-k", "1"] if self._inject_jit else [])
-        self._process: Optional[Popen] = None
-
-    def _get_perf_cmd(self) -> List[str]:
-        return [
+        extra_args = extra_args + (["-k", "1"] if self._inject_jit else [])
+        self._perf_cmd = (
             perf_path(),
             "record",
             "-F",
@@ -75,13 +82,15 @@ class PerfProcess:
             # here)
             "-m",
             str(self._mmap_sizes[self._type]),
-        ] + self._extra_args
+            *extra_args,
+        )
+        self._process: Optional[Popen] = None
 
     def start(self) -> None:
         logger.info(f"Starting perf ({self._type} mode)")
-        process = start_process(self._get_perf_cmd(), via_staticx=False)
+        process = start_process(list(self._perf_cmd), via_staticx=False)
         try:
-            wait_event(self._poll_timeout_s, self._stop_event, lambda: os.path.exists(self._output_path))
+            wait_for_glob(self._output_path, self._poll_timeout_s, self._stop_event)
         except TimeoutError:
             process.kill()
             assert process.stdout is not None and process.stderr is not None
@@ -102,7 +111,11 @@ class PerfProcess:
         assert self._process is not None, "profiling not started!"
         self._process.send_signal(signal.SIGUSR2)
 
-    def wait_and_script(self) -> str:
+    def wait_and_script(self) -> "PerfScriptOutput":
+        """
+        Waits for perf to dump its output, and starts "perf script" on it. The output lines are streamed from
+        "perf script" as they are consumed (see PerfScriptOutput), which must be closed afterwards.
+        """
         try:
             perf_data = wait_for_file_by_prefix(f"{self._output_path}.", self._dump_timeout_s, self._stop_event)
         except Exception:
@@ -121,18 +134,59 @@ class PerfProcess:
 
         if self._inject_jit:
             inject_data = Path(f"{str(perf_data)}.inject")
-            run_process(
-                [perf_path(), "inject", "--jit", "-o", str(inject_data), "-i", str(perf_data)],
-            )
-            perf_data.unlink()
+            with removed_path(str(perf_data)):
+                run_process(
+                    [perf_path(), "inject", "--jit", "-o", str(inject_data), "-i", str(perf_data)],
+                )
             perf_data = inject_data
 
-        perf_script_proc = run_process(
-            [perf_path(), "script", "-F", "+pid", "-i", str(perf_data)],
-            suppress_log=True,
-        )
-        perf_data.unlink()
-        return perf_script_proc.stdout.decode("utf8")
+        return PerfScriptOutput(perf_data)
+
+
+class PerfScriptOutput:
+    """
+    Runs "perf script" on a perf.data file, whose output lines are read by iterating this object - so the (possibly
+    huge) output isn't held in memory all at once.
+    close() stops "perf script" and removes the perf.data file, whether or not the output was read.
+    """
+
+    def __init__(self, perf_data: Path):
+        self._exit_stack = ExitStack()
+        with self._exit_stack:
+            self._exit_stack.enter_context(removed_path(str(perf_data)))
+            # stderr goes to a file so "perf script" can't block on a full stderr pipe while we read its stdout.
+            self._stderr = self._exit_stack.enter_context(TemporaryFile())
+            self._process = start_process(
+                [perf_path(), "script", "-F", "+pid", "-i", str(perf_data)], via_staticx=False, stderr=self._stderr
+            )
+            self._exit_stack.enter_context(self._process)  # closes the pipes & waits for the process on exit
+            # succeeded, keep everything for close()
+            self._exit_stack = self._exit_stack.pop_all()
+
+    def __iter__(self) -> Iterator[bytes]:
+        assert self._process.stdout is not None
+        yield from self._process.stdout
+
+        if self._process.wait() != 0:
+            self._stderr.seek(0)
+            raise CalledProcessError(self._process.returncode, self._process.args, stderr=self._stderr.read())
+
+    def close(self) -> None:
+        if self._process.poll() is None:
+            # our caller didn't consume all of the output, don't wait on a writer blocked on a full pipe.
+            self._process.kill()
+        self._exit_stack.close()
+
+    def __enter__(self) -> "PerfScriptOutput":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_ctb: Optional[TracebackType],
+    ) -> None:
+        self.close()
 
 
 @register_profiler(
@@ -152,7 +206,15 @@ class PerfProcess:
             type=int,
             default=DEFAULT_PERF_DWARF_STACK_SIZE,
             dest="perf_dwarf_stack_size",
-        )
+        ),
+        ProfilerArgument(
+            "--perf-lbr",
+            help="In --perf-mode smart, if the CPU supports LBR call stacks, run a single perf with"
+            " '--call-graph lbr' instead of running both FP and DWARF perfs. This lowers the overhead, but LBR"
+            " call stacks are limited in depth (16-32 frames, depending on the CPU).",
+            action="store_true",
+            dest="perf_lbr",
+        ),
     ],
     disablement_help="Disable the global perf of processes,"
     " and instead only concatenate runtime-specific profilers results",
@@ -163,6 +225,8 @@ class SystemProfiler(ProfilerBase):
     This improves the results from software that is compiled without frame pointers,
     like some native software. DWARF by itself is not good enough, as it has issues with unwinding some
     versions of Go processes.
+    If requested (--perf-lbr) and supported by the CPU, we run a single perf with LBR call stacks instead, which
+    doesn't depend on frame pointers either.
     """
 
     def __init__(
@@ -176,19 +240,39 @@ class SystemProfiler(ProfilerBase):
         perf_dwarf_stack_size: int,
         perf_inject: bool,
         perf_node_attach: bool,
+        perf_lbr: bool,
     ):
         super().__init__(frequency, duration, stop_event, storage_dir)
         _ = profile_spawned_processes  # Required for mypy unused argument warning
         self._perfs: List[PerfProcess] = []
         self._metadata_collectors: List[PerfMetadata] = [GolangPerfMetadata(stop_event), NodePerfMetadata(stop_event)]
         self._node_processes: List[Process] = []
+        self._node_process_contexts: NodeProcessContexts = {}
+
+        use_lbr = False
+        if perf_mode == "smart" and perf_lbr:
+            if is_lbr_supported():
+                use_lbr = True
+            else:
+                logger.warning("LBR call stacks are not supported on this CPU, running both FP and DWARF perfs")
 
-        if perf_mode in ("fp", "smart"):
+        if use_lbr:
+            # the LBR perf replaces both the FP & DWARF perfs, so its results are used as-is by the merge.
             self._perf_fp: Optional[PerfProcess] = PerfProcess(
+                self._frequency,
+                self._stop_event,
+                os.path.join(self._storage_dir, "perf.lbr"),
+                "lbr",
+                perf_inject,
+                ["--call-graph", "lbr"],
+            )
+            self._perfs.append(self._perf_fp)
+        elif perf_mode in ("fp", "smart"):
+            self._perf_fp = PerfProcess(
                 self._frequency,
                 self._stop_event,
                 os.path.join(self._storage_dir, "perf.fp"),
-                False,
+                "fp",
                 perf_inject,
                 [],
             )
@@ -196,12 +280,12 @@ class SystemProfiler(ProfilerBase):
         else:
             self._perf_fp = None
 
-        if perf_mode in ("dwarf", "smart"):
+        if perf_mode in ("dwarf", "smart") and not use_lbr:
             self._perf_dwarf: Optional[PerfProcess] = PerfProcess(
                 self._frequency,
                 self._stop_event,
                 os.path.join(self._storage_dir, "perf.dwarf"),
-                True,
+                "dwarf",
                 False,  # no inject in dwarf mode, yet
                 ["--call-graph", f"dwarf,{perf_dwarf_stack_size}"],
             )
@@ -216,15 +300,16 @@ class SystemProfiler(ProfilerBase):
         # we have to also generate maps here,
         # it might be too late for first round to generate it in snapshot()
         if self.perf_node_attach:
+            load_dso_git_rev()
             self._node_processes = get_node_processes()
-            generate_map_for_node_processes(self._node_processes)
+            generate_map_for_node_processes(self._node_processes, self._node_process_contexts)
         for perf in self._perfs:
             perf.start()
 
     def stop(self) -> None:
         if self.perf_node_attach:
             self._node_processes = [process for process in self._node_processes if is_process_running(process)]
-            clean_up_node_maps(self._node_processes)
+            clean_up_node_maps(self._node_processes, self._node_process_contexts)
         for perf in reversed(self._perfs):
             perf.stop()
 
@@ -243,10 +328,14 @@ class SystemProfiler(ProfilerBase):
 
     def snapshot(self) -> ProcessToProfileData:
         if self.perf_node_attach:
-            self._node_processes = [process for process in self._node_processes if is_process_running(process)]
-            new_processes = [process for process in get_node_processes() if process not in self._node_processes]
-            generate_map_for_node_processes(new_processes)
-            self._node_processes.extend(new_processes)
+            # processes compare by (pid, create time), so the processes we already know of which are still running
+            # are exactly those found again - no need to check each of them separately.
+            node_processes = get_node_processes()
+            known_processes = set(self._node_processes)
+            new_processes = [process for process in node_processes if process not in known_processes]
+            generate_map_for_node_processes(new_processes, self._node_process_contexts)
+            self._node_processes = node_processes
+            prune_node_processes_cache(self._node_processes, self._node_process_contexts)
 
         if self._stop_event.wait(self._duration):
             raise StopEventSetException
@@ -254,14 +343,17 @@ class SystemProfiler(ProfilerBase):
         for perf in self._perfs:
             perf.switch_output()
 
-        return {
-            # TODO generate appids for non runtime-profiler processes here
-            k: ProfileData(v, None, self._get_metadata(k))
-            for k, v in merge.merge_global_perfs(
-                self._perf_fp.wait_and_script() if self._perf_fp is not None else None,
-                self._perf_dwarf.wait_and_script() if self._perf_dwarf is not None else None,
-            ).items()
-        }
+        with ExitStack() as exit_stack:
+            # entered one by one, so the output of one perf is cleaned up if waiting for the other fails.
+            fp_output = exit_stack.enter_context(self._perf_fp.wait_and_script()) if self._perf_fp is not None else None
+            dwarf_output = (
+                exit_stack.enter_context(self._perf_dwarf.wait_and_script()) if self._perf_dwarf is not None else None
+            )
+            return {
+                # TODO generate appids for non runtime-profiler processes here
+                k: ProfileData(v, None, self._get_metadata(k))
+                for k, v in merge.merge_global_perfs(fp_output, dwarf_output).items()
+            }
 
 
 class PerfMetadata(ApplicationMetadata):
@@ -285,16 +377,17 @@ class PerfMetadata(ApplicationMetadata):
 
 class GolangPerfMetadata(PerfMetadata):
     def relevant_for_process(self, process: Process) -> bool:
-        version = self._get_golang_version(process)
+        version = self._get_golang_version(process.pid, process.create_time())
         return version is not None
 
-    @functools.lru_cache(maxsize=4096)
-    def _get_golang_version(self, process: Process) -> Optional[str]:
-        elf_path = f"/proc/{process.pid}/exe"
+    # keyed by (pid, create_time) so a reused PID doesn't get the version of the previous process
+    @functools.lru_cache(maxsize=1024)
+    def _get_golang_version(self, pid: int, create_time: float) -> Optional[str]:
+        elf_path = f"/proc/{pid}/exe"
         try:
             symbol_data = read_elf_symbol(elf_path, "runtime.buildVersion", 16)
         except FileNotFoundError:
-            raise NoSuchProcess(process.pid)
+            raise NoSuchProcess(pid)
         if symbol_data is None:
             return None
 
@@ -307,14 +400,14 @@ class GolangPerfMetadata(PerfMetadata):
         try:
             golang_version_bytes = read_elf_va(elf_path, addr, length)
         except FileNotFoundError:
-            raise NoSuchProcess(process.pid)
+            raise NoSuchProcess(pid)
         if golang_version_bytes is None:
             return None
 
         return golang_version_bytes.decode()
 
     def make_application_metadata(self, process: Process) -> Dict[str, Any]:
-        metadata = {"golang_version": self._get_golang_version(process)}
+        metadata = {"golang_version": self._get_golang_version(process.pid, process.create_time())}
         self.add_exe_metadata(process, metadata)
         metadata.update(super().make_application_metadata(process))
         return metadata
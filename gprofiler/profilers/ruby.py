@@ -30,7 +30,8 @@ logger = get_logger_adapter(__name__)
 class RubyMetadata(ApplicationMetadata):
     _RUBY_VERSION_TIMEOUT = 3
 
-    @functools.lru_cache(4096)
+    # process is hashable by (pid, create_time), so a reused PID doesn't get the version of the previous process
+    @functools.lru_cache(1024)
     def _get_ruby_version(self, process: Process) -> str:
         if not is_process_basename_matching(process, r"^ruby"):  # startswith match
             # TODO: for dynamic executables, find the ruby binary that works with the loaded libruby, and
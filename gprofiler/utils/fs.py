@@ -4,17 +4,28 @@
 #
 
 import errno
+import fcntl
+import glob
 import os
 import shutil
+import time
 from pathlib import Path
 from secrets import token_hex
 from threading import Event
 from typing import Union, Iterator
 from contextlib import contextmanager
+from gprofiler.exceptions import StopEventSetException
+from gprofiler.log import get_logger_adapter
+from gprofiler.utils import wait_event
+from gprofiler.utils.inotify import IN_CREATE, IN_MOVED_TO, InotifyWatch
 from gprofiler.utils.process import run_process
 from functools import lru_cache
 import importlib_resources
 
+logger = get_logger_adapter(__name__)
+
+_WAIT_FOR_GLOB_STOP_EVENT_INTERVAL = 0.1
+
 
 @lru_cache(maxsize=None)
 def resource_path(relative_path: str = "") -> str:
@@ -53,6 +64,77 @@ def safe_copy(src: str, dst: str) -> None:
     os.rename(dst_tmp, dst)
 
 
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+# copy_file_range / sendfile may not be supported between some pairs of files (e.g across filesystems on older
+# kernels); these are the errors they fail with in that case, before copying anything.
+_KERNEL_COPY_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, size: int) -> bool:
+    """
+    Copies 'size' bytes from 'src_fd' to 'dst_fd' within the kernel, without passing the data through userspace.
+    Returns False if neither copy_file_range nor sendfile can be used for these files (and nothing was copied).
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)  # python >= 3.8
+    for copy in (copy_file_range, os.sendfile):
+        if copy is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                else:
+                    n = copy(src_fd, dst_fd, size - copied)
+                if n == 0:  # file was truncated meanwhile
+                    break
+                copied += n
+            return True
+        except OSError as e:
+            if copied > 0 or e.errno not in _KERNEL_COPY_UNSUPPORTED_ERRNOS:
+                raise
+    return False
+
+
+def reflink_copy(src: str, dst: str) -> str:
+    """
+    Copies 'src' to 'dst' by sharing its extents (reflink), on filesystems that support it (e.g btrfs, xfs).
+    Otherwise, copies the data within the kernel, and falls back to a regular copy if that's not possible either.
+    Can be used as the 'copy_function' of shutil.copytree().
+    """
+    with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+        try:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+        except OSError:
+            if not _kernel_copy(src_f.fileno(), dst_f.fileno(), os.fstat(src_f.fileno()).st_size):
+                shutil.copyfileobj(src_f, dst_f)
+
+    shutil.copystat(src, dst)
+    return dst
+
+
+def link_tree(src: str, dest: str) -> None:
+    """
+    Like shutil.copytree(), but hard-links the files instead of copying them. If that's not possible (e.g 'src' and
+    'dest' are on different filesystems), falls back to copying the tree with reflink_copy().
+    The files in 'dest' share their content & mode with 'src', so use it only for trees that aren't modified.
+    """
+    try:
+        for root, _, files in os.walk(src):
+            dest_root = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+            os.makedirs(dest_root)
+            for name in files:
+                os.link(os.path.join(root, name), os.path.join(dest_root, name))
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.copytree(src, dest, copy_function=reflink_copy)
+
+
 def is_rw_exec_dir(path: str) -> bool:
     """
     Is 'path' rw and exec?
@@ -84,9 +166,36 @@ def is_rw_exec_dir(path: str) -> bool:
     return True
 
 
+def wait_for_glob(glob_pattern: str, timeout: float, stop_event: Event) -> None:
+    """
+    Waits until a file matching 'glob_pattern' exists. Uses inotify on the directory of the pattern so we're
+    woken up as soon as a file is created (or renamed) there, and falls back to polling if inotify is not available.
+    """
+    try:
+        watch = InotifyWatch(os.path.dirname(glob_pattern) or ".", IN_CREATE | IN_MOVED_TO)
+    except OSError:
+        logger.debug("Failed to create inotify watch, polling instead", exc_info=True)
+        wait_event(timeout, stop_event, lambda: len(glob.glob(glob_pattern)) > 0)
+        return
+
+    with watch:
+        end_time = time.monotonic() + timeout
+        # the watch is added before the first check, so we can't miss a file created in between.
+        while len(glob.glob(glob_pattern)) == 0:
+            if stop_event.is_set():
+                raise StopEventSetException()
+
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError()
+
+            # the wait is bounded so we respond to stop_event quickly.
+            watch.wait(min(remaining, _WAIT_FOR_GLOB_STOP_EVENT_INTERVAL))
+
+
 def wait_for_file_by_prefix(prefix: str, timeout: float, stop_event: Event) -> Path:
     glob_pattern = f"{prefix}*"
-    wait_event(timeout, stop_event, lambda: len(glob.glob(glob_pattern)) > 0)
+    wait_for_glob(glob_pattern, timeout, stop_event)
 
     output_files = glob.glob(glob_pattern)
     # All the snapshot samples should be in one file
@@ -0,0 +1,80 @@
+#
+# Copyright (c) Granulate. All rights reserved.
+# Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
+#
+import ctypes
+import math
+import os
+import select
+from types import TracebackType
+from typing import Optional, Type
+
+# from linux/inotify.h
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_libc: Optional[ctypes.CDLL] = None
+
+
+def _get_libc() -> ctypes.CDLL:
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    return _libc
+
+
+def _check_ret(ret: int) -> int:
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ret
+
+
+class InotifyWatch:
+    """
+    Minimal inotify(7) watch on a single path, used to wait for filesystem events instead of polling.
+    """
+
+    def __init__(self, path: str, mask: int):
+        libc = _get_libc()
+        self._fd = _check_ret(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            _check_ret(libc.inotify_add_watch(self._fd, os.fsencode(path), mask))
+        except OSError:
+            os.close(self._fd)
+            raise
+        # poll() rather than select(), which doesn't support fds >= FD_SETSIZE (1024)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits up to 'timeout' seconds for events. Returns True if any events were received (they're consumed).
+        """
+        # rounded up, so we don't wake up (and spin) just before the timeout
+        if not self._poll.poll(math.ceil(timeout * 1000)):
+            return False
+
+        # we don't care about the events themselves, just drain them.
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def __enter__(self) -> "InotifyWatch":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_ctb: Optional[TracebackType],
+    ) -> None:
+        self.close()
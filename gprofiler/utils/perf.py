@@ -2,6 +2,8 @@
 # Copyright (c) Granulate. All rights reserved.
 # Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
 #
+import os
+from functools import lru_cache
 
 from gprofiler.exceptions import CalledProcessError
 from gprofiler.log import get_logger_adapter
@@ -11,10 +13,19 @@ from gprofiler.utils.process import run_process
 logger = get_logger_adapter(__name__)
 
 
+@lru_cache(maxsize=None)
 def perf_path() -> str:
     return resource_path("perf")
 
 
+# exists on CPUs with LBR (Last Branch Record) support; holds the number of LBR entries.
+LBR_CAPS_PATH = "/sys/bus/event_source/devices/cpu/caps/branches"
+
+
+def is_lbr_supported() -> bool:
+    return os.path.exists(LBR_CAPS_PATH)
+
+
 def can_i_use_perf_events() -> bool:
     # checks access to perf_events
     # TODO invoking perf has a toll of about 1 second on my box; maybe we want to directly call
@@ -6,18 +6,34 @@
 import os
 import re
 import signal
+import subprocess
+import time
 from functools import lru_cache
-from typing import Any, Match, Optional, Union, List, Tuple
+from typing import Any, Dict, Match, Optional, Pattern, Set, Union, List, Tuple, cast
 from subprocess import CompletedProcess, Popen, TimeoutExpired
-from threading import Event
+from threading import Event, Lock
 
+import psutil
 from granulate_utils.linux.process import process_exe, read_proc_file
 from psutil import Process
+from gprofiler.log import get_logger_adapter
 from gprofiler.utils import get_staticx_dir
 
+logger = get_logger_adapter(__name__)
 
-def search_proc_maps(process: Process, pattern: str) -> Optional[Match[str]]:
-    return re.search(pattern, read_proc_file(process, "maps").decode(), re.MULTILINE)
+
+@lru_cache(maxsize=64)
+def _compile_maps_pattern(pattern: str) -> Pattern[str]:
+    return re.compile(pattern, re.MULTILINE)
+
+
+def search_proc_maps(process: Process, pattern: Union[str, Pattern[str]]) -> Optional[Match[str]]:
+    """
+    'pattern' is matched against the entire maps file - compiled patterns should be compiled with re.MULTILINE.
+    """
+    if isinstance(pattern, str):
+        pattern = _compile_maps_pattern(pattern)
+    return pattern.search(read_proc_file(process, "maps").decode())
 
 
 def process_comm(process: Process) -> str:
@@ -162,8 +178,8 @@ def run_process(
     return result
 
 
-def pgrep_exe(match: str) -> List[Process]:
-    pattern = re.compile(match)
+def pgrep_exe(match: Union[str, Pattern[str]]) -> List[Process]:
+    pattern = re.compile(match) if isinstance(match, str) else match
     procs = []
     for process in psutil.process_iter():
         try:
@@ -175,13 +191,30 @@ def pgrep_exe(match: str) -> List[Process]:
     return procs
 
 
-def pgrep_maps(match: str) -> List[Process]:
+# pgrep_maps() results are shared between the profilers: they all select their processes at the beginning of
+# each snapshot, so a single scan of /proc/*/maps (for all patterns requested so far) serves all of them.
+# Once snapshot rounds are started (see new_maps_scan_round()), a single scan serves each round, however long
+# it took. Until then (e.g profilers used directly, without the main snapshot loop), results at most
+# _MAPS_SCAN_MAX_AGE seconds old (counted from the end of the scan) are reused.
+_MAPS_SCAN_MAX_AGE = 1.0
+_maps_scan_lock = Lock()
+_maps_scan_patterns: List[str] = []
+_maps_scan_round = 0
+_maps_scan_result_round = -1
+_maps_scan_time = 0.0
+_maps_scan_result: Dict[str, List[Process]] = {}
+
+
+def _grep_proc_maps(grep_args: str, match: str) -> bytes:
     # this is much faster than iterating over processes' maps with psutil.
+    # LC_ALL=C makes grep match bytes instead of decoding UTF-8, which is considerably faster (and maps are ASCII
+    # anyway, save for odd file names). /proc/[0-9]* skips /proc/self & /proc/thread-self (which are grep itself).
     result = run_process(
-        f"grep -lP '{match}' /proc/*/maps",
+        f"grep {grep_args} '{match}' /proc/[0-9]*/maps",
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         shell=True,
+        env=dict(os.environ, LC_ALL="C"),
         suppress_log=True,
         check=False,
     )
@@ -205,13 +238,81 @@ def pgrep_maps(match: str) -> List[Process]:
     if error_lines:
         logger.error(f"Unexpected 'grep' error output (first 10 lines): {error_lines[:10]}")
 
-    processes: List[Process] = []
-    for line in result.stdout.splitlines():
-        assert line.startswith(b"/proc/") and line.endswith(b"/maps"), f"unexpected 'grep' line: {line!r}"
-        pid = int(line[len(b"/proc/") : -len(b"/maps")])
+    return cast(bytes, result.stdout)
+
+
+def _maps_path_pid(path: bytes) -> int:
+    assert path.startswith(b"/proc/") and path.endswith(b"/maps"), f"unexpected 'grep' line: {path!r}"
+    return int(path[len(b"/proc/") : -len(b"/maps")])
+
+
+def scan_proc_maps(patterns: List[str]) -> Dict[str, List[Process]]:
+    """
+    Finds the processes whose maps match each of 'patterns', reading /proc/*/maps once for all of them.
+    :returns: Mapping from each pattern to the processes matching it.
+    """
+    results: Dict[str, List[Process]] = {pattern: [] for pattern in patterns}
+    if not patterns:
+        return results
+
+    if len(patterns) == 1:
+        # with a single pattern, "-l" lets grep stop reading each maps file at its first match.
+        for line in _grep_proc_maps("-lP", patterns[0]).splitlines():
+            try:
+                results[patterns[0]].append(Process(_maps_path_pid(line)))
+            except psutil.NoSuchProcess:
+                continue  # process might have died meanwhile
+        return results
+
+    # grep matches line by line, so we match the same lines again to tell which of the patterns they matched.
+    combined = "|".join(f"(?:{pattern})" for pattern in patterns)
+    compiled = [(pattern, re.compile(pattern)) for pattern in patterns]
+    matched: Dict[int, Set[str]] = {}
+    for line in _grep_proc_maps("-HP", combined).splitlines():
+        path, _, maps_line = line.partition(b":")
+        pid = _maps_path_pid(path)
+        pid_matched = matched.setdefault(pid, set())
+        if len(pid_matched) == len(compiled):
+            continue
+        decoded_line = maps_line.decode(errors="replace")
+        for pattern, regex in compiled:
+            if pattern not in pid_matched and regex.search(decoded_line) is not None:
+                pid_matched.add(pattern)
+
+    for pid, pid_matched in matched.items():
         try:
-            processes.append(Process(pid))
+            process = Process(pid)
         except psutil.NoSuchProcess:
             continue  # process might have died meanwhile
+        for pattern in pid_matched:
+            results[pattern].append(process)
+
+    return results
 
-    return processes
\ No newline at end of file
+
+def new_maps_scan_round() -> None:
+    """
+    Marks the beginning of a new snapshot round: the next pgrep_maps() call rescans /proc/*/maps.
+    """
+    global _maps_scan_round
+    with _maps_scan_lock:
+        _maps_scan_round += 1
+
+
+def pgrep_maps(match: str) -> List[Process]:
+    global _maps_scan_time, _maps_scan_result, _maps_scan_result_round
+    with _maps_scan_lock:
+        if match not in _maps_scan_patterns:
+            _maps_scan_patterns.append(match)
+        # the first call with a new pattern, or in a new round, or (if no rounds were started) after the results
+        # have aged, rescans for all patterns.
+        if (
+            match not in _maps_scan_result
+            or _maps_scan_result_round != _maps_scan_round
+            or (_maps_scan_round == 0 and time.monotonic() - _maps_scan_time > _MAPS_SCAN_MAX_AGE)
+        ):
+            _maps_scan_result = scan_proc_maps(_maps_scan_patterns)
+            _maps_scan_result_round = _maps_scan_round
+            # taken after the scan, so callers waiting on the lock while it ran still get its results.
+            _maps_scan_time = time.monotonic()
+        return list(_maps_scan_result[match])
@@ -8,6 +8,7 @@ import subprocess
 from contextlib import _GeneratorContextManager, contextmanager
 from functools import lru_cache, partial
 from pathlib import Path
+from threading import Event
 from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Mapping, Optional, Tuple, cast
 
 import docker
@@ -47,6 +48,17 @@ def profiler_type() -> str:
     raise NotImplementedError
 
 
+@fixture(scope="module")
+def stop_event() -> Iterator[Event]:
+    """
+    Stop event shared by the profilers (and metadata collectors) created in a test module. It's set on teardown,
+    after the module's profilers are stopped, so anything still waiting on it returns.
+    """
+    event = Event()
+    yield event
+    event.set()
+
+
 @contextmanager
 def chdir(path: Path) -> Iterator[None]:
     cwd = os.getcwd()
@@ -292,14 +304,27 @@ def application_image_tag() -> str:
     return ""
 
 
+@fixture(scope="session")
+def built_application_docker_images() -> Dict[str, Image]:
+    """
+    Images built so far in this session, by image name. Each image is used by many tests (e.g the Python matrix
+    image of each tag is used by all profiler types), so it's built once.
+    """
+    return {}
+
+
 @fixture
 def application_docker_image(
     docker_client: DockerClient,
     application_docker_image_configs: Mapping[str, Dict[str, Any]],
+    built_application_docker_images: Dict[str, Image],
     runtime: str,
     application_image_tag: str,
 ) -> Iterable[Image]:
-    yield _build_image(docker_client, **application_docker_image_configs[image_name(runtime, application_image_tag)])
+    name = image_name(runtime, application_image_tag)
+    if name not in built_application_docker_images:
+        built_application_docker_images[name] = _build_image(docker_client, **application_docker_image_configs[name])
+    yield built_application_docker_images[name]
 
 
 @fixture
@@ -524,6 +549,7 @@ def _set_enrichment_options() -> None:
 def pytest_addoption(parser: Any) -> None:
     parser.addoption("--exec-container-image", action="store", default=None)
     parser.addoption("--executable", action="store", default=None)
+    parser.addoption("--run-slow", action="store_true", default=False, help="Run tests marked as slow")
 
 
 def pytest_collection_modifyitems(session: pytest.Session, config: Config, items: List[pytest.Item]) -> None:
@@ -534,6 +560,12 @@ def pytest_collection_modifyitems(session: pytest.Session, config: Config, items
     # tests first we were alleviated of those issues.
     items.sort(key=lambda i: not i.name.startswith("test_from_container"))
 
+    if not config.getoption("--run-slow"):
+        skip_slow = pytest.mark.skip(reason="slow test, use --run-slow to run it")
+        for item in items:
+            if "slow" in item.keywords:
+                item.add_marker(skip_slow)
+
 
 @fixture
 def python_version(in_container: bool, application_docker_container: Container) -> Optional[str]:
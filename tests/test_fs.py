@@ -0,0 +1,222 @@
+#
+# Copyright (c) Granulate. All rights reserved.
+# Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
+#
+
+"""
+Tests for the logic from gprofiler/utils/fs.py
+"""
+
+import errno
+import os
+import resource
+import shutil
+import time
+from pathlib import Path
+from threading import Event, Timer
+from typing import Any, Callable, Iterator, List
+
+import pytest
+from pytest import MonkeyPatch
+
+from gprofiler.exceptions import StopEventSetException
+from gprofiler.utils.fs import _kernel_copy, link_tree, reflink_copy, wait_for_glob
+
+SHM_PATH = "/dev/shm"
+
+
+@pytest.fixture
+def src_tree(tmp_path: Path) -> Path:
+    src = tmp_path / "src"
+    (src / "glibc" / "16").mkdir(parents=True)
+    (src / "musl").mkdir()
+    (src / "version").write_text("abcdef\n")
+    (src / "glibc" / "16" / "linux-perf.js").write_text("module.exports = {};\n")
+    (src / "glibc" / "16" / "linux-perf.node").write_bytes(os.urandom(256 * 1024))
+    (src / "glibc" / "16" / "linux-perf.node").chmod(0o755)
+    return src
+
+
+@pytest.fixture
+def shm_dest() -> Iterator[Path]:
+    if not os.path.isdir(SHM_PATH):
+        pytest.skip(f"{SHM_PATH} doesn't exist")
+    dest = Path(SHM_PATH) / f"gprofiler-test-{os.getpid()}"
+    try:
+        yield dest
+    finally:
+        shutil.rmtree(dest, ignore_errors=True)
+
+
+def _assert_trees_equal(src: Path, dest: Path) -> None:
+    src_paths = sorted(path.relative_to(src) for path in src.rglob("*"))
+    assert src_paths == sorted(path.relative_to(dest) for path in dest.rglob("*"))
+    for path in src_paths:
+        assert (src / path).is_dir() == (dest / path).is_dir()
+        if (src / path).is_file():
+            assert (src / path).read_bytes() == (dest / path).read_bytes()
+            assert (src / path).stat().st_mode == (dest / path).stat().st_mode
+
+
+def test_link_tree_same_filesystem(tmp_path: Path, src_tree: Path) -> None:
+    dest = tmp_path / "dest" / "rev"
+    link_tree(str(src_tree), str(dest))
+
+    _assert_trees_equal(src_tree, dest)
+    for path in src_tree.rglob("*"):
+        if path.is_file():
+            assert path.samefile(dest / path.relative_to(src_tree))
+
+
+def test_link_tree_cross_filesystem(tmp_path: Path, src_tree: Path, shm_dest: Path) -> None:
+    if os.stat(SHM_PATH).st_dev == os.stat(tmp_path).st_dev:
+        pytest.skip(f"{SHM_PATH} and {tmp_path} are on the same filesystem")
+
+    link_tree(str(src_tree), str(shm_dest))
+
+    _assert_trees_equal(src_tree, shm_dest)
+    for path in src_tree.rglob("*"):
+        if path.is_file():
+            assert not path.samefile(shm_dest / path.relative_to(src_tree))
+
+
+def test_link_tree_falls_back_to_copy(tmp_path: Path, src_tree: Path, monkeypatch: MonkeyPatch) -> None:
+    def link(*args: Any) -> None:
+        raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+
+    monkeypatch.setattr(os, "link", link)
+    dest = tmp_path / "dest"
+    link_tree(str(src_tree), str(dest))
+
+    _assert_trees_equal(src_tree, dest)
+
+
+def test_reflink_copy(src_tree: Path, tmp_path: Path) -> None:
+    src = src_tree / "glibc" / "16" / "linux-perf.node"
+    dest = tmp_path / "linux-perf.node"
+    assert reflink_copy(str(src), str(dest)) == str(dest)
+
+    assert src.read_bytes() == dest.read_bytes()
+    assert src.stat().st_mode == dest.stat().st_mode
+
+
+def test_reflink_copy_without_kernel_copy(src_tree: Path, tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    def unsupported(*args: Any) -> int:
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    # also forces the FICLONE ioctl to fail on reflink-capable filesystems
+    monkeypatch.setattr("gprofiler.utils.fs.fcntl.ioctl", unsupported)
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    monkeypatch.setattr(os, "sendfile", unsupported)
+
+    src = src_tree / "glibc" / "16" / "linux-perf.node"
+    dest = tmp_path / "linux-perf.node"
+    reflink_copy(str(src), str(dest))
+
+    assert src.read_bytes() == dest.read_bytes()
+
+
+def test_kernel_copy_falls_back_to_sendfile(src_tree: Path, tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    def unsupported(*args: Any) -> int:
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+
+    src = src_tree / "glibc" / "16" / "linux-perf.node"
+    dest = tmp_path / "linux-perf.node"
+    with open(src, "rb") as src_f, open(dest, "wb") as dst_f:
+        assert _kernel_copy(src_f.fileno(), dst_f.fileno(), src.stat().st_size)
+
+    assert src.read_bytes() == dest.read_bytes()
+
+
+def test_kernel_copy_unsupported(src_tree: Path, tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    def unsupported(*args: Any) -> int:
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    monkeypatch.setattr(os, "sendfile", unsupported)
+
+    src = src_tree / "version"
+    dest = tmp_path / "version"
+    with open(src, "rb") as src_f, open(dest, "wb") as dst_f:
+        assert not _kernel_copy(src_f.fileno(), dst_f.fileno(), src.stat().st_size)
+
+    assert dest.read_bytes() == b""
+
+
+def _in_background(delay: float, function: Callable[[], Any]) -> Timer:
+    timer = Timer(delay, function)
+    timer.start()
+    return timer
+
+
+def test_wait_for_glob_existing_file(tmp_path: Path) -> None:
+    (tmp_path / "perf.data.1").touch()
+    wait_for_glob(str(tmp_path / "perf.data.*"), 0, Event())
+
+
+@pytest.mark.parametrize("rename", [False, True])
+def test_wait_for_glob_file_created_later(tmp_path: Path, rename: bool) -> None:
+    def create() -> None:
+        if rename:
+            # like perf, which writes its output under a temporary name and renames it
+            (tmp_path / "tmp").write_text("data")
+            (tmp_path / "tmp").rename(tmp_path / "perf.data.1")
+        else:
+            (tmp_path / "perf.data.1").touch()
+
+    timer = _in_background(0.2, create)
+    start = time.monotonic()
+    wait_for_glob(str(tmp_path / "perf.data.*"), 10, Event())
+    # woken up by the file, not by the timeout
+    assert time.monotonic() - start < 5
+    timer.join()
+
+
+def test_wait_for_glob_timeout(tmp_path: Path) -> None:
+    (tmp_path / "other").touch()
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        wait_for_glob(str(tmp_path / "perf.data.*"), 0.3, Event())
+    assert time.monotonic() - start >= 0.3
+
+
+def test_wait_for_glob_stop_event(tmp_path: Path) -> None:
+    stop_event = Event()
+    timer = _in_background(0.2, stop_event.set)
+    start = time.monotonic()
+    with pytest.raises(StopEventSetException):
+        wait_for_glob(str(tmp_path / "perf.data.*"), 10, stop_event)
+    assert time.monotonic() - start < 5
+    timer.join()
+
+
+@pytest.fixture
+def high_fds() -> Iterator[None]:
+    """
+    Occupies the fds below 1100, so new fds are above FD_SETSIZE (1024) - as in gProfiler, which runs with a high
+    nofile limit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < 2048:
+        pytest.skip(f"nofile hard limit is too low ({hard})")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 2048), hard))
+    fds: List[int] = []
+    try:
+        fd = os.open(os.devnull, os.O_RDONLY)
+        fds.append(fd)
+        while fd < 1100:
+            fd = os.dup(fds[0])
+            fds.append(fd)
+        yield
+    finally:
+        for fd in fds:
+            os.close(fd)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_wait_for_glob_high_fd(tmp_path: Path, high_fds: None) -> None:
+    timer = _in_background(0.2, (tmp_path / "perf.data.1").touch)
+    wait_for_glob(str(tmp_path / "perf.data.*"), 10, Event())
+    timer.join()
@@ -9,7 +9,7 @@ Tests for the logic from gprofiler/merge.py
 
 import pytest
 
-from gprofiler.merge import get_average_frame_count
+from gprofiler.merge import get_average_frame_count, merge_global_perfs
 
 
 @pytest.mark.parametrize(
@@ -26,3 +26,21 @@ from gprofiler.merge import get_average_frame_count
 )
 def test_get_average_frame_count(samples: str, count: float) -> None:
     assert get_average_frame_count(samples) == count
+
+
+def test_merge_global_perfs_parses_streamed_lines() -> None:
+    script = (
+        b"python 1234/1235 [001] 100.000001: 1 cpu-clock: \n"
+        b"\t7fe48f00faff __poll+0x4f (/lib/x86_64-linux-gnu/libc-2.31.so)\n"
+        b"\t55d4c1a3e1a0 main+0x10 (/usr/bin/python3.8)\n"
+        b"\n"
+        b"python 1234/1234 [000] 100.000002: 1 cpu-clock: \n"
+        b"\tffffffff81082227 mmput+0x57 ([kernel.kallsyms])\n"
+        b"\t55d4c1a3e1a0 main+0x10 (/usr/bin/python3.8)\n"
+        b"\n"
+        b"python 1234/1234 [000] 100.000003: 1 cpu-clock: \n"
+        b"\t7fe48f00faff __poll+0x4f (/lib/x86_64-linux-gnu/libc-2.31.so)\n"
+        b"\t55d4c1a3e1a0 main+0x10 (/usr/bin/python3.8)\n"
+    )
+    merged = merge_global_perfs(iter(script.splitlines(keepends=True)), None)
+    assert merged == {1234: {"python;main;__poll": 2, "python;main;mmput_[k]": 1}}
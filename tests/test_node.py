@@ -1,43 +1,68 @@
 #
 # Copyright (c) Granulate. All rights reserved.
 # Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
+import json
 from pathlib import Path
 from threading import Event
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple, cast
 
 import pytest
 from docker import DockerClient
 from docker.models.images import Image
+from pytest import MonkeyPatch
+from websocket._core import WebSocket
 
-from gprofiler.merge import parse_one_collapsed
+from gprofiler.profilers import node
+from gprofiler.profilers.node import (
+    NodeDebuggerUnexpectedResponse,
+    _change_dso_state,
+    _change_dso_state_in_ns,
+    _execute_js_commands,
+    _NodeProcessContext,
+)
 from gprofiler.profilers.perf import SystemProfiler
 from tests import CONTAINERS_DIRECTORY
 from tests.conftest import AssertInCollapsed
-from tests.utils import assert_function_in_collapsed, run_gprofiler_in_container_for_one_session, snapshot_pid_collapsed
+from tests.utils import (
+    assert_function_in_collapsed,
+    run_gprofiler_in_container_for_one_session_collapsed,
+    snapshot_pid_collapsed,
+)
 
 
 @pytest.mark.parametrize("profiler_type", ["attach-maps"])
 @pytest.mark.parametrize("runtime", ["nodejs"])
 @pytest.mark.parametrize("application_image_tag", ["without-flags"])
 @pytest.mark.parametrize("command_line", [["node", f"{CONTAINERS_DIRECTORY}/nodejs/fibonacci.js"]])
+@pytest.mark.parametrize(
+    "frequency,duration",
+    [
+        pytest.param(99, 2, id="fast"),
+        pytest.param(1000, 6, id="slow", marks=pytest.mark.slow),
+    ],
+)
 def test_nodejs_attach_maps(
     tmp_path: Path,
+    stop_event: Event,
     application_pid: int,
     assert_collapsed: AssertInCollapsed,
     profiler_type: str,
     command_line: List[str],
     runtime_specific_args: List[str],
+    frequency: int,
+    duration: int,
 ) -> None:
     with SystemProfiler(
-        1000,
-        6,
-        Event(),
+        frequency,
+        duration,
+        stop_event,
         str(tmp_path),
         False,
         perf_mode="fp",
         perf_inject=False,
         perf_dwarf_stack_size=0,
         perf_node_attach=True,
+        perf_lbr=False,
     ) as profiler:
         process_collapsed = snapshot_pid_collapsed(profiler, application_pid)
         assert_collapsed(process_collapsed)
@@ -62,8 +87,116 @@ def test_nodejs_attach_maps_from_container(
     profiler_flags: List[str],
 ) -> None:
     _ = application_pid  # Fixture only used for running the application.
-    collapsed_text = run_gprofiler_in_container_for_one_session(
+    collapsed = run_gprofiler_in_container_for_one_session_collapsed(
         docker_client, gprofiler_docker_image, output_directory, output_collapsed, runtime_specific_args, profiler_flags
     )
-    collapsed = parse_one_collapsed(collapsed_text)
     assert_collapsed(collapsed)
+
+
+class FakeDebuggerSocket:
+    """
+    Stands in for the debugger's WebSocket: records the sent requests, and replies with 'responses' in order.
+    """
+
+    def __init__(self, responses: List[Dict[str, Any]]):
+        self.sent: List[Dict[str, Any]] = []
+        self.closed = False
+        self._responses = [json.dumps(response) for response in responses]
+
+    def send(self, message: str) -> None:
+        self.sent.append(json.loads(message))
+
+    def recv(self) -> str:
+        return self._responses.pop(0)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def _evaluate_response(request_id: int, result_type: str, value: Any) -> Dict[str, Any]:
+    return {"id": request_id, "result": {"result": {"type": result_type, "value": value}}}
+
+
+def test_execute_js_commands_matches_responses_by_id() -> None:
+    sock = FakeDebuggerSocket(
+        [
+            _evaluate_response(3, "number", 3),
+            _evaluate_response(1, "string", "a"),
+            _evaluate_response(2, "boolean", True),
+        ]
+    )
+    assert _execute_js_commands(cast(WebSocket, sock), ["a", "b", "c"]) == ["a", True, 3]
+    # all requests are sent before the first response is read
+    assert [(request["id"], request["params"]["expression"]) for request in sock.sent] == [(1, "a"), (2, "b"), (3, "c")]
+
+
+@pytest.mark.parametrize(
+    "response_ids",
+    [
+        pytest.param([1, 3], id="unexpected"),
+        pytest.param([1, 1], id="duplicate"),
+        pytest.param([None, 2], id="missing"),
+    ],
+)
+def test_execute_js_commands_unexpected_response_id(response_ids: List[Optional[int]]) -> None:
+    responses = [_evaluate_response(1, "string", "a") for _ in response_ids]
+    for response, response_id in zip(responses, response_ids):
+        response["id"] = response_id
+    with pytest.raises(NodeDebuggerUnexpectedResponse):
+        _execute_js_commands(cast(WebSocket, FakeDebuggerSocket(responses)), ["a", "b"])
+
+
+@pytest.mark.parametrize("action", ["start", "stop"])
+def test_change_dso_state_substitutes_module_path(action: str) -> None:
+    sock = FakeDebuggerSocket([_evaluate_response(1, "boolean", True)])
+    _change_dso_state(cast(WebSocket, sock), "/tmp/gprofiler_tmp/node_module/rev/glibc/16/", action)
+    assert sock.sent == [
+        {
+            "id": 1,
+            "method": "Runtime.evaluate",
+            "params": {
+                "expression": 'process.mainModule.require("/tmp/gprofiler_tmp/node_module/rev/glibc/16/linux-perf.js")'
+                f".{action}()",
+                "replMode": True,
+            },
+        }
+    ]
+
+
+def test_change_dso_state_unexpected_response() -> None:
+    sock = FakeDebuggerSocket([_evaluate_response(1, "undefined", None)])
+    with pytest.raises(NodeDebuggerUnexpectedResponse):
+        _change_dso_state(cast(WebSocket, sock), "/tmp/module", "start")
+
+
+def test_change_dso_state_in_ns_refetches_stale_debugger_url(monkeypatch: MonkeyPatch) -> None:
+    ctx = _NodeProcessContext("pid:[4026531836]", 1, "16", "/tmp/module", debugger_url="ws://127.0.0.1:9229/old")
+    sock = FakeDebuggerSocket([_evaluate_response(1, "boolean", True)])
+    connections: List[Tuple[str, bool]] = []
+
+    def create_debugger_socket(debugger_url: str, nspid: int, ns_link_name: str, validate: bool = True) -> WebSocket:
+        connections.append((debugger_url, validate))
+        if debugger_url.endswith("/old"):
+            raise ConnectionRefusedError()
+        return cast(WebSocket, sock)
+
+    monkeypatch.setattr(node, "create_debugger_socket", create_debugger_socket)
+    monkeypatch.setattr(node, "_get_debugger_url", lambda: "ws://127.0.0.1:9229/new")
+
+    _change_dso_state_in_ns(ctx, "stop")
+
+    # the cached URL isn't validated again, but a newly queried one is.
+    assert connections == [("ws://127.0.0.1:9229/old", False), ("ws://127.0.0.1:9229/new", True)]
+    assert ctx.debugger_url == "ws://127.0.0.1:9229/new"
+    # the connection isn't kept open - Node waits for debuggers to disconnect before exiting.
+    assert sock.closed
+
+
+def test_change_dso_state_in_ns_closes_socket_on_error(monkeypatch: MonkeyPatch) -> None:
+    ctx = _NodeProcessContext("pid:[4026531836]", 1, "16", "/tmp/module", debugger_url="ws://127.0.0.1:9229/id")
+    sock = FakeDebuggerSocket([{"id": 1, "error": {"message": "boom"}}])
+    monkeypatch.setattr(node, "create_debugger_socket", lambda *args, **kwargs: sock)
+
+    with pytest.raises(NodeDebuggerUnexpectedResponse):
+        _change_dso_state_in_ns(ctx, "start")
+    assert sock.closed
@@ -11,11 +11,17 @@ import pytest
 from docker.models.containers import Container
 
 from gprofiler.profilers.perf import DEFAULT_PERF_DWARF_STACK_SIZE, SystemProfiler
+from gprofiler.utils.perf import is_lbr_supported
 from tests.utils import assert_function_in_collapsed, is_function_in_collapsed, snapshot_pid_collapsed
 
 
 @pytest.fixture
-def system_profiler(tmp_path: Path, perf_mode: str) -> SystemProfiler:
+def perf_lbr() -> bool:
+    return False
+
+
+@pytest.fixture
+def system_profiler(tmp_path: Path, perf_mode: str, perf_lbr: bool) -> SystemProfiler:
     return SystemProfiler(
         99,
         1,
@@ -26,6 +32,7 @@ def system_profiler(tmp_path: Path, perf_mode: str) -> SystemProfiler:
         perf_inject=False,
         perf_dwarf_stack_size=DEFAULT_PERF_DWARF_STACK_SIZE,
         perf_node_attach=False,
+        perf_lbr=perf_lbr,
     )
 
 
@@ -58,6 +65,26 @@ def test_perf_fp_dwarf_smart(
         )
 
 
+@pytest.mark.skipif(not is_lbr_supported(), reason="LBR call stacks are not supported on this CPU")
+@pytest.mark.parametrize("runtime", ["native_fp", "native_dwarf"])
+@pytest.mark.parametrize("perf_mode", ["smart"])
+@pytest.mark.parametrize("perf_lbr", [True])
+@pytest.mark.parametrize("in_container", [True])  # native app is built only for container
+def test_perf_lbr(
+    system_profiler: SystemProfiler,
+    application_pid: int,
+    runtime: str,
+) -> None:
+    with system_profiler as profiler:
+        # a single LBR perf replaces the FP & DWARF perfs
+        assert len(profiler._perfs) == 1
+        process_collapsed = snapshot_pid_collapsed(profiler, application_pid)
+
+        # LBR call stacks depend on neither FP nor DWARF info, so both apps are unwound.
+        # the LBR depth is limited, so we don't expect to see the frames below the recursion (e.g main).
+        assert_function_in_collapsed(";recursive;recursive;recursive;recursive;", process_collapsed)
+
+
 def _restart_app_container(application_docker_container: Container) -> int:
     application_docker_container.restart(timeout=0)
     application_docker_container.reload()  # post restart
@@ -0,0 +1,134 @@
+#
+# Copyright (c) Granulate. All rights reserved.
+# Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
+#
+
+"""
+Tests for the logic from gprofiler/utils/process.py
+"""
+
+import os
+import subprocess
+import time
+from typing import Dict, Iterator, List
+
+import pytest
+from psutil import Process
+from pytest import MonkeyPatch
+
+from gprofiler.utils import process as process_utils
+from gprofiler.utils.process import new_maps_scan_round, pgrep_maps, scan_proc_maps
+
+# larger than the maximal pid (4194304), so no such process exists
+NON_EXISTING_PID = 4194305
+
+
+@pytest.fixture
+def other_pid() -> Iterator[int]:
+    popen = subprocess.Popen(["sleep", "1000"])
+    try:
+        yield popen.pid
+    finally:
+        popen.kill()
+        popen.wait()
+
+
+def _pids(processes: List[Process]) -> List[int]:
+    return sorted(process.pid for process in processes)
+
+
+def test_scan_proc_maps_dispatches_combined_patterns(monkeypatch: MonkeyPatch, other_pid: int) -> None:
+    my_pid = os.getpid()
+    grep_output = (
+        f"/proc/{my_pid}/maps:7f0000000000-7f0000001000 r-xp 00000000 08:01 1 /usr/lib/libpython3.8.so.1.0\n"
+        f"/proc/{my_pid}/maps:7f0000001000-7f0000002000 r-xp 00000000 08:01 2 /usr/lib/jvm/lib/server/libjvm.so\n"
+        f"/proc/{my_pid}/maps:7f0000002000-7f0000003000 r-xp 00000000 08:01 3 /usr/lib/libpython3.8.so.1.0\n"
+        f"/proc/{other_pid}/maps:7f0000000000-7f0000001000 r-xp 00000000 08:01 2 /usr/lib/jvm/lib/server/libjvm.so\n"
+        f"/proc/{NON_EXISTING_PID}/maps:7f0000000000-7f0000001000 r-xp 00000000 08:01 1 /usr/lib/libpython3.8.so\n"
+    ).encode()
+    grep_calls = []
+
+    def grep_proc_maps(grep_args: str, match: str) -> bytes:
+        grep_calls.append((grep_args, match))
+        return grep_output
+
+    monkeypatch.setattr(process_utils, "_grep_proc_maps", grep_proc_maps)
+
+    python_pattern = r"^.+/libpython[^/]*$"
+    java_pattern = r"^.+/libjvm\.so"
+    dotnet_pattern = r"^.+/dotnet[^/]*$"
+    results = scan_proc_maps([python_pattern, java_pattern, dotnet_pattern])
+
+    # a single grep for all patterns
+    assert grep_calls == [("-HP", f"(?:{python_pattern})|(?:{java_pattern})|(?:{dotnet_pattern})")]
+    # my_pid matches 2 patterns, and the non existing pid is skipped.
+    assert _pids(results[python_pattern]) == [my_pid]
+    assert _pids(results[java_pattern]) == sorted([my_pid, other_pid])
+    assert results[dotnet_pattern] == []
+
+
+def test_scan_proc_maps_single_pattern_lists_files(monkeypatch: MonkeyPatch, other_pid: int) -> None:
+    my_pid = os.getpid()
+    grep_calls = []
+
+    def grep_proc_maps(grep_args: str, match: str) -> bytes:
+        grep_calls.append((grep_args, match))
+        return f"/proc/{my_pid}/maps\n/proc/{NON_EXISTING_PID}/maps\n/proc/{other_pid}/maps\n".encode()
+
+    monkeypatch.setattr(process_utils, "_grep_proc_maps", grep_proc_maps)
+
+    pattern = r"^.+/libpython[^/]*$"
+    results = scan_proc_maps([pattern])
+
+    assert grep_calls == [("-lP", pattern)]
+    assert _pids(results[pattern]) == sorted([my_pid, other_pid])
+
+
+@pytest.fixture
+def maps_scans(monkeypatch: MonkeyPatch) -> List[List[str]]:
+    """
+    Resets the state of pgrep_maps(), and records the patterns of each scan it runs.
+    """
+    monkeypatch.setattr(process_utils, "_maps_scan_patterns", [])
+    monkeypatch.setattr(process_utils, "_maps_scan_result", {})
+    monkeypatch.setattr(process_utils, "_maps_scan_round", 0)
+    monkeypatch.setattr(process_utils, "_maps_scan_result_round", -1)
+    monkeypatch.setattr(process_utils, "_maps_scan_time", 0.0)
+    scans: List[List[str]] = []
+
+    def scan(patterns: List[str]) -> Dict[str, List[Process]]:
+        scans.append(list(patterns))
+        return {pattern: [] for pattern in patterns}
+
+    monkeypatch.setattr(process_utils, "scan_proc_maps", scan)
+    return scans
+
+
+def test_pgrep_maps_scans_once_per_round(maps_scans: List[List[str]], monkeypatch: MonkeyPatch) -> None:
+    new_maps_scan_round()
+    pgrep_maps("a")
+    pgrep_maps("a")
+    # a new pattern rescans for all of the patterns
+    pgrep_maps("b")
+    pgrep_maps("a")
+    assert maps_scans == [["a"], ["a", "b"]]
+
+    new_maps_scan_round()
+    pgrep_maps("b")
+    pgrep_maps("a")
+    assert maps_scans == [["a"], ["a", "b"], ["a", "b"]]
+
+    # within a round, the results are reused however old they are
+    monkeypatch.setattr(process_utils, "_maps_scan_time", time.monotonic() - 10 * process_utils._MAPS_SCAN_MAX_AGE)
+    pgrep_maps("a")
+    assert len(maps_scans) == 3
+
+
+def test_pgrep_maps_without_rounds_rescans_aged_results(maps_scans: List[List[str]], monkeypatch: MonkeyPatch) -> None:
+    pgrep_maps("a")
+    pgrep_maps("a")
+    assert maps_scans == [["a"]]
+
+    monkeypatch.setattr(process_utils, "_maps_scan_time", time.monotonic() - 10 * process_utils._MAPS_SCAN_MAX_AGE)
+    pgrep_maps("a")
+    assert maps_scans == [["a"], ["a"]]
@@ -2,17 +2,31 @@
 # Copyright (c) Granulate. All rights reserved.
 # Licensed under the AGPL3 License. See LICENSE.md in the project root for license information.
 #
+import itertools
 import os
-from pathlib import Path
+from contextlib import ExitStack
 from threading import Event
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Tuple, cast
 
 import psutil
 import pytest
+from _pytest.mark import MarkDecorator
+from docker import DockerClient
+from docker.models.containers import Container
+from docker.models.images import Image
+from docker.types import Mount
 from granulate_utils.linux.process import is_musl
+from pytest import TempPathFactory
 
-from gprofiler.profilers.python import PythonProfiler
+from gprofiler.profilers.python import PythonMetadata, PythonProfiler
 from tests.conftest import AssertInCollapsed
-from tests.utils import assert_function_in_collapsed, snapshot_pid_collapsed, snapshot_pid_profile
+from tests.utils import (
+    _application_docker_container,
+    assert_function_in_collapsed,
+    assert_functions_in_collapsed,
+    snapshot_pid_collapsed,
+    snapshot_pid_profile,
+)
 
 
 @pytest.fixture
@@ -20,10 +34,121 @@ def runtime() -> str:
     return "python"
 
 
+PythonProfilerFactory = Callable[[str, int, int], PythonProfiler]
+
+
+class PythonImageTag(NamedTuple):
+    """application_image_tag of the Python matrix images, e.g "3.7-musl-uwsgi"."""
+
+    python_version: str
+    libc: str
+    app: str
+
+
+@pytest.fixture
+def python_image_tag(application_image_tag: str) -> PythonImageTag:
+    python_version, libc, app = application_image_tag.split("-")
+    return PythonImageTag(python_version, libc, app)
+
+
+@pytest.fixture(scope="module")
+def python_matrix_containers() -> Iterator[Dict[str, Tuple[ExitStack, Container]]]:
+    """
+    Application containers of the Python matrix tests, by image tag (with the ExitStack that removes them).
+    """
+    containers: Dict[str, Tuple[ExitStack, Container]] = {}
+    yield containers
+    for exit_stack, _ in containers.values():
+        exit_stack.close()
+
+
+@pytest.fixture
+def python_matrix_application_pid(
+    python_matrix_containers: Dict[str, Tuple[ExitStack, Container]],
+    docker_client: DockerClient,
+    application_docker_image: Image,
+    application_docker_mounts: List[Mount],
+    application_docker_capabilities: List[str],
+    application_image_tag: str,
+) -> int:
+    """
+    Like application_pid, but consecutive tests of the same image (e.g of different profiler types) share the
+    application container instead of starting a new one each.
+    """
+    cached = python_matrix_containers.get(application_image_tag)
+    if cached is not None:
+        container = cached[1]
+        container.reload()
+        if container.status == "running":
+            return cast(int, container.attrs["State"]["Pid"])
+
+    # keep only a single container running (per xdist worker) - the application keeps the CPU busy, which would
+    # affect other tests.
+    for exit_stack, _ in python_matrix_containers.values():
+        exit_stack.close()
+    python_matrix_containers.clear()
+
+    exit_stack = ExitStack()
+    container = exit_stack.enter_context(
+        _application_docker_container(
+            docker_client, application_docker_image, application_docker_mounts, application_docker_capabilities
+        )
+    )
+    python_matrix_containers[application_image_tag] = (exit_stack, container)
+    return cast(int, container.attrs["State"]["Pid"])
+
+
+@pytest.fixture
+def application_is_musl(python_matrix_application_pid: int) -> bool:
+    return is_musl(psutil.Process(python_matrix_application_pid))
+
+
+# the tests only look for a few well-known frames, so a short & low frequency session is enough; the original
+# rates are kept as "slow" variants (see --run-slow).
+PROFILING_RATES = [
+    pytest.param(99, 1, id="fast"),
+    pytest.param(1000, 2, id="slow", marks=pytest.mark.slow),
+]
+
+
+@pytest.fixture(scope="module")
+def python_profiler_factory(tmp_path_factory: TempPathFactory, stop_event: Event) -> Iterator[PythonProfilerFactory]:
+    """
+    Returns a function which creates a started PythonProfiler for a (profiler type, frequency, duration), and reuses it
+    in the following tests of that profiler type with the same rate - starting a profiler is costly (e.g PyPerf has to
+    compile & load its eBPF programs) while snapshot() can be called repeatedly on a running profiler.
+    """
+    # profiler type -> ((frequency, duration), started profiler). a profiler is kept per type, because the py-spy &
+    # PyPerf tests of each image run one after the other. a profiler of another rate replaces the running one, so
+    # PyPerf instances of both rates don't run concurrently and sample each other's tests.
+    profilers: Dict[str, Tuple[Tuple[int, int], PythonProfiler]] = {}
+
+    def get_profiler(profiler_type: str, frequency: int, duration: int) -> PythonProfiler:
+        rate = (frequency, duration)
+        cached = profilers.pop(profiler_type, None)
+        if cached is not None:
+            cached_rate, cached_profiler = cached
+            if cached_rate == rate:
+                profilers[profiler_type] = cached
+                return cached_profiler
+            cached_profiler.stop()
+
+        storage_dir = tmp_path_factory.mktemp(f"python-{profiler_type}-{frequency}-{duration}")
+        profiler = PythonProfiler(frequency, duration, stop_event, str(storage_dir), False, profiler_type, True, None)
+        profiler.start()
+        profilers[profiler_type] = (rate, profiler)
+        return profiler
+
+    yield get_profiler
+
+    for _, profiler in profilers.values():
+        profiler.stop()
+
+
 @pytest.mark.parametrize("in_container", [True])
 @pytest.mark.parametrize("application_image_tag", ["libpython"])
 def test_python_select_by_libpython(
-    tmp_path: Path,
+    python_profiler_factory: PythonProfilerFactory,
     application_pid: int,
     assert_collapsed: AssertInCollapsed,
 ) -> None:
@@ -33,54 +158,70 @@ def test_python_select_by_libpython(
     We expect to select these because they have "libpython" in their "/proc/pid/maps".
     This test runs a Python named "shmython".
     """
-    with PythonProfiler(1000, 1, Event(), str(tmp_path), False, "pyspy", True, None) as profiler:
-        process_collapsed = snapshot_pid_collapsed(profiler, application_pid)
+    profiler = python_profiler_factory("pyspy", 1000, 1)
+    process_collapsed = snapshot_pid_collapsed(profiler, application_pid)
     assert_collapsed(process_collapsed)
-    assert all(stack.startswith("shmython") for stack in process_collapsed.keys())
+    assert all(stack.startswith("shmython") for stack in process_collapsed)
 
 
-@pytest.mark.parametrize("in_container", [True])
-@pytest.mark.parametrize(
-    "application_image_tag",
-    [
-        "2.7-glibc-python",
-        "2.7-musl-python",
-        "3.5-glibc-python",
-        "3.5-musl-python",
-        "3.6-glibc-python",
-        "3.6-musl-python",
-        "3.7-glibc-python",
-        "3.7-musl-python",
-        "3.8-glibc-python",
-        "3.8-musl-python",
-        "3.9-glibc-python",
-        "3.9-musl-python",
-        "3.10-glibc-python",
-        "3.10-musl-python",
-        "2.7-glibc-uwsgi",
-        "2.7-musl-uwsgi",
-        "3.7-glibc-uwsgi",
-        "3.7-musl-uwsgi",
-    ],
-)
-@pytest.mark.parametrize("profiler_type", ["py-spy", "pyperf"])
+# Python versions tested with each app (the "python" executable and uWSGI), each on both glibc & musl.
+PYTHON_MATRIX_VERSIONS = {
+    "python": ["2.7", "3.5", "3.6", "3.7", "3.8", "3.9", "3.10"],
+    "uwsgi": ["2.7", "3.7"],
+}
+PYTHON_MATRIX_IMAGE_TAGS = [
+    f"{python_version}-{libc}-{app}"
+    for app, python_versions in PYTHON_MATRIX_VERSIONS.items()
+    for python_version, libc in itertools.product(python_versions, ("glibc", "musl"))
+]
+
+
+def python_matrix_group(image_tag: str) -> MarkDecorator:
+    """
+    The tests of an image are kept on a single xdist worker (with --dist=loadgroup), so they run one after the other
+    and share the application container (see python_matrix_application_pid).
+    """
+    return pytest.mark.xdist_group(name=f"python-{image_tag}")
+
+
+def python_matrix_params() -> List[Any]:
+    """
+    (application_image_tag, profiler_type) parameters of test_python_matrix. Unsupported combinations are marked
+    here, so they're skipped before their application container is started.
+    """
+    params = []
+    for image_tag in PYTHON_MATRIX_IMAGE_TAGS:
+        python_version, _, app = image_tag.split("-")
+        for profiler_type in ("py-spy", "pyperf"):
+            marks = [python_matrix_group(image_tag)]
+            if python_version == "3.5" and profiler_type == "pyperf":
+                marks.append(pytest.mark.skip(reason="PyPerf doesn't support Python 3.5!"))
+            if python_version == "2.7" and profiler_type == "pyperf" and app == "uwsgi":
+                marks.append(
+                    pytest.mark.xfail(
+                        reason="This combination fails, see https://github.com/Granulate/gprofiler/issues/485",
+                        run=False,
+                    )
+                )
+            params.append(pytest.param(image_tag, profiler_type, marks=marks))
+    return params
+
+
+@pytest.mark.parametrize("application_image_tag,profiler_type", python_matrix_params())
+@pytest.mark.parametrize("frequency,duration", PROFILING_RATES)
 def test_python_matrix(
-    tmp_path: Path,
-    application_pid: int,
+    python_profiler_factory: PythonProfilerFactory,
+    python_matrix_application_pid: int,
     assert_collapsed: AssertInCollapsed,
     profiler_type: str,
-    application_image_tag: str,
+    python_image_tag: PythonImageTag,
+    frequency: int,
+    duration: int,
 ) -> None:
-    python_version, libc, app = application_image_tag.split("-")
-
-    if python_version == "3.5" and profiler_type == "pyperf":
-        pytest.skip("PyPerf doesn't support Python 3.5!")
+    python_version = python_image_tag.python_version
 
-    if python_version == "2.7" and profiler_type == "pyperf" and app == "uwsgi":
-        pytest.xfail("This combination fails, see https://github.com/Granulate/gprofiler/issues/485")
-
-    with PythonProfiler(1000, 2, Event(), str(tmp_path), False, profiler_type, True, None) as profiler:
-        profile = snapshot_pid_profile(profiler, application_pid)
+    profiler = python_profiler_factory(profiler_type, frequency, duration)
+    profile = snapshot_pid_profile(profiler, python_matrix_application_pid)
 
     collapsed = profile.stacks
 
@@ -88,26 +229,50 @@ def test_python_matrix(
     # searching for "python_version.", because ours is without the patchlevel.
     assert_function_in_collapsed(f"standard-library=={python_version}.", collapsed)
 
-    assert libc in ("musl", "glibc")
-    assert (libc == "musl") == is_musl(psutil.Process(application_pid))
-
     if profiler_type == "pyperf":
-        # we expect to see kernel code
-        assert_function_in_collapsed("do_syscall_64_[k]", collapsed)
-        # and native user code
-        assert_function_in_collapsed(
-            "PyEval_EvalFrameEx_[pn]" if python_version == "2.7" else "_PyEval_EvalFrameDefault_[pn]", collapsed
+        assert_functions_in_collapsed(
+            [
+                # we expect to see kernel code
+                "do_syscall_64_[k]",
+                # and native user code
+                "PyEval_EvalFrameEx_[pn]" if python_version == "2.7" else "_PyEval_EvalFrameDefault_[pn]",
+                # ensure class name exists for instance methods
+                "lister.Burner.burner",
+                # ensure class name exists for class methods
+                "lister.Lister.lister",
+            ],
+            collapsed,
         )
-        # ensure class name exists for instance methods
-        assert_function_in_collapsed("lister.Burner.burner", collapsed)
-        # ensure class name exists for class methods
-        assert_function_in_collapsed("lister.Lister.lister", collapsed)
 
+    # the metadata itself is checked in test_python_matrix_app_metadata
     assert profile.app_metadata is not None
-    assert os.path.basename(profile.app_metadata["execfn"]) == app
+
+
+@pytest.mark.parametrize(
+    "application_image_tag",
+    [pytest.param(image_tag, marks=python_matrix_group(image_tag)) for image_tag in PYTHON_MATRIX_IMAGE_TAGS],
+)
+def test_python_matrix_app_metadata(
+    python_matrix_application_pid: int,
+    python_image_tag: PythonImageTag,
+    application_is_musl: bool,
+    stop_event: Event,
+) -> None:
+    """
+    Checks the application metadata collected for the images of test_python_matrix. This doesn't depend on the
+    profiler type nor on a profiling session, so it's collected directly.
+    """
+    python_version, libc, app = python_image_tag
+
+    assert libc in ("musl", "glibc")
+    assert (libc == "musl") == application_is_musl
+
+    app_metadata = PythonMetadata(stop_event).get_metadata(psutil.Process(python_matrix_application_pid))
+    assert app_metadata is not None
+    assert os.path.basename(app_metadata["execfn"]) == app
     # searching for "python_version.", because ours is without the patchlevel.
-    assert profile.app_metadata["python_version"].startswith(f"Python {python_version}.")
+    assert app_metadata["python_version"].startswith(f"Python {python_version}.")
     if python_version == "2.7" and app == "python":
-        assert profile.app_metadata["sys_maxunicode"] == "1114111"
+        assert app_metadata["sys_maxunicode"] == "1114111"
     else:
-        assert profile.app_metadata["sys_maxunicode"] is None
+        assert app_metadata["sys_maxunicode"] is None
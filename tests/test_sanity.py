@@ -27,7 +27,7 @@ from tests.utils import (
     RUNTIME_PROFILERS,
     assert_function_in_collapsed,
     make_java_profiler,
-    run_gprofiler_in_container_for_one_session,
+    run_gprofiler_in_container_for_one_session_collapsed,
     snapshot_pid_collapsed,
     start_gprofiler_in_container_for_one_session,
     wait_for_gprofiler_container,
@@ -124,6 +124,7 @@ def test_nodejs(
         perf_inject=True,
         perf_dwarf_stack_size=0,
         perf_node_attach=False,
+        perf_lbr=False,
     ) as profiler:
         process_collapsed = snapshot_pid_collapsed(profiler, application_pid)
         assert_collapsed(process_collapsed)
@@ -178,10 +179,9 @@ def test_from_container(
 ) -> None:
     _ = application_pid  # Fixture only used for running the application.
     _ = assert_app_id  # Required for mypy unused argument warning
-    collapsed_text = run_gprofiler_in_container_for_one_session(
+    collapsed = run_gprofiler_in_container_for_one_session_collapsed(
         docker_client, gprofiler_docker_image, output_directory, output_collapsed, runtime_specific_args, profiler_flags
     )
-    collapsed = parse_one_collapsed(collapsed_text)
     assert_collapsed(collapsed)
 
 
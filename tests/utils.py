@@ -9,7 +9,7 @@ from contextlib import contextmanager
 from pathlib import Path
 from threading import Event
 from time import sleep
-from typing import Any, Dict, Iterator, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 from docker import DockerClient
 from docker.errors import ContainerError
@@ -18,6 +18,7 @@ from docker.models.images import Image
 from docker.types import Mount
 
 from gprofiler.gprofiler_types import ProfileData, StackToSampleCount
+from gprofiler.merge import parse_one_collapsed
 from gprofiler.profilers.java import (
     JAVA_ASYNC_PROFILER_DEFAULT_SAFEMODE,
     JAVA_SAFEMODE_ALL,
@@ -162,6 +163,19 @@ def assert_function_in_collapsed(function_name: str, collapsed: StackToSampleCou
     assert is_function_in_collapsed(function_name, collapsed), f"function {function_name!r} missing in collapsed data!"
 
 
+def assert_functions_in_collapsed(function_names: Iterable[str], collapsed: StackToSampleCount) -> None:
+    """
+    Like assert_function_in_collapsed() for multiple functions, checking all of them in a single pass over 'collapsed'.
+    """
+    print(f"collapsed: {collapsed}")
+    missing = set(function_names)
+    for record in collapsed.keys():
+        missing = {function_name for function_name in missing if function_name not in record}
+        if not missing:
+            break
+    assert not missing, f"functions {sorted(missing)!r} missing in collapsed data!"
+
+
 def snapshot_pid_profile(profiler: ProfilerInterface, pid: int) -> ProfileData:
     return profiler.snapshot()[pid]
 
@@ -267,6 +281,24 @@ def run_gprofiler_in_container_for_one_session(
             container.remove()
 
 
+def run_gprofiler_in_container_for_one_session_collapsed(
+    docker_client: DockerClient,
+    gprofiler_docker_image: Image,
+    output_directory: Path,
+    output_path: Path,
+    runtime_specific_args: List[str],
+    profiler_flags: List[str],
+) -> StackToSampleCount:
+    """
+    Like run_gprofiler_in_container_for_one_session(), but returns the parsed collapsed stacks.
+    """
+    return parse_one_collapsed(
+        run_gprofiler_in_container_for_one_session(
+            docker_client, gprofiler_docker_image, output_directory, output_path, runtime_specific_args, profiler_flags
+        )
+    )
+
+
 def _print_process_output(popen: subprocess.Popen) -> None:
     stdout, stderr = popen.communicate()
     print(f"stdout: {stdout.decode()}")